@@ -1,9 +1,13 @@
 from django.contrib import admin
-from .models import Product, ProductImage, Coupon, SubSection, Section, Customer, OrderItem, Order, Cart, CartItem,Banner,Alert,DeviceToken, brand
+from .models import Product, ProductImage, Coupon, SubSection, Section, Customer, OrderItem, Order, Cart, CartItem,Banner,Alert,DeviceToken, brand, OrderEvent
 from django.urls import path, reverse
 from django.shortcuts import get_object_or_404, redirect
 from django.contrib import messages
-from .apns import send_notification_to_all_devices
+from .tasks import enqueue_alert_broadcast
+from .broadcast import stalled_alerts
+from django.db import transaction
+from django.db.models import Q
+from functools import partial
 import logging
 
 from django.utils.html import format_html
@@ -20,9 +24,12 @@ class ProductAdmin(admin.ModelAdmin):
     def is_low_stock_indicator(self, obj):
         return obj.is_low_stock()
     is_low_stock_indicator.boolean = True
-    @admin.display(description='السعر بعد الخصم')
+    @admin.display(description='السعر بعد الخصم', ordering='effective_price')
     def calculate_discounted_price(self,obj):
-        return obj.calculate_discounted_price()
+        return obj.effective_price
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_effective_price()
 
 @admin.register(Coupon)
 class CouponAdmin(admin.ModelAdmin):
@@ -79,6 +86,13 @@ class CartItemAdmin(admin.ModelAdmin):
     list_display = ['cart', 'product', 'quantity']
 
 
+@admin.register(OrderEvent)
+class OrderEventAdmin(admin.ModelAdmin):
+    list_display = ['order', 'sink', 'status', 'attempts', 'next_attempt_at', 'sent_at']
+    list_filter = ['status', 'sink']
+    readonly_fields = ['created_at', 'sent_at', 'last_error']
+
+
 @admin.register(Banner)
 class BannerAdmin(admin.ModelAdmin):
     list_display = ['id', 'image_preview', 'section', 'subsection', 'created_at']
@@ -102,9 +116,22 @@ logger = logging.getLogger(__name__)
 
 @admin.register(Alert)
 class AlertAdmin(admin.ModelAdmin):
-    list_display = ['title', 'created_at', 'is_sent', 'send_now_link']
+    list_display = ['title', 'created_at', 'status', 'progress', 'send_now_link']
+    list_filter = ['status']
+    readonly_fields = ['is_sent', 'status', 'total_count', 'sent_count', 'failed_count', 'pruned_count', 'started_at', 'finished_at', 'heartbeat_at']
     actions = ['send_selected_alerts']
 
+    def save_model(self, request, obj, form, change):
+        """
+        Edits write only the changed content fields, never the progress a
+        worker may be updating meanwhile.
+        """
+        if not change:
+            return super().save_model(request, obj, form, change)
+        changed = [field for field in Alert.CONTENT_FIELDS if field in form.changed_data]
+        if changed:
+            obj.save(update_fields=changed)
+
     def get_urls(self):
         """
         Adds a custom URL for sending alerts.
@@ -115,45 +142,67 @@ class AlertAdmin(admin.ModelAdmin):
         ]
         return custom_urls + urls
 
+    @admin.display(description="التقدم")
+    def progress(self, obj):
+        """
+        Live counters, updated by the worker after every batch.
+        """
+        if obj.status == Alert.PENDING:
+            return "-"
+        return format_html(
+            "{} sent / {} failed / {} pending of {} ({} pruned)",
+            obj.sent_count, obj.failed_count, obj.pending_count, obj.total_count, obj.pruned_count
+        )
+
     def send_now_link(self, obj):
         """
         Creates a 'Send Now' button in the admin list view.
         """
+        if obj.status == Alert.SENDING:
+            return "Sending..."
         if not obj.is_sent:
             url = reverse("admin:send_alert", args=[obj.id])
             return format_html('<a class="button" href="{}">Send Now</a>', url)
         return "Already Sent"
     send_now_link.short_description = "Send Now"
 
+    def queue(self, alert_ids):
+        """
+        Queues (or re-queues failed and stalled) alerts for the workers without
+        waiting for them; a re-queued alert resumes from its cursor. Returns
+        the ids that were queued.
+        """
+        alert_ids = list(
+            Alert.objects.filter(Q(status__in=[Alert.PENDING, Alert.FAILED]) | stalled_alerts(), pk__in=alert_ids, is_sent=False)
+            .values_list('pk', flat=True)
+        )
+        Alert.objects.filter(pk__in=alert_ids).update(status=Alert.PENDING)
+        for alert_id in alert_ids:
+            transaction.on_commit(partial(enqueue_alert_broadcast, alert_id))
+        return alert_ids
+
     def send_alert_view(self, request, alert_id):
         """
         Custom admin view to send a specific alert.
         """
         alert = get_object_or_404(Alert, pk=alert_id)
-        if not alert.is_sent:
-            send_notification_to_all_devices(alert.title, alert.message)
-            alert.is_sent = True
-            alert.save()
-            messages.success(request, "Alert sent to all devices.")
-            logger.info(f"Alert '{alert.title}' sent to all devices.")
+        if self.queue([alert.pk]):
+            messages.success(request, "Alert queued for sending.")
+            logger.info(f"Alert '{alert.title}' queued for all devices.")
         else:
-            messages.warning(request, "Alert was already sent.")
+            messages.warning(request, "Alert was already sent or is being sent.")
         return redirect('admin:api_alert_changelist')  # Replace 'yourapp' with your actual app name
 
     def send_selected_alerts(self, request, queryset):
         """
         Admin action to send multiple selected alerts.
         """
-        not_sent = queryset.filter(is_sent=False)
-        for alert in not_sent:
-            send_notification_to_all_devices(alert.title, alert.message)
-            alert.is_sent = True
-            alert.save()
-            logger.info(f"Alert '{alert.title}' sent to all devices.")
-        self.message_user(request, f"{not_sent.count()} alerts have been sent.")
+        queued = self.queue(queryset.values_list('pk', flat=True))
+        self.message_user(request, f"{len(queued)} alerts have been queued for sending.")
     send_selected_alerts.short_description = "Send selected alerts now"
 
 @admin.register(DeviceToken)
 class DeviceTokenAdmin(admin.ModelAdmin):
-    list_display = ['token', 'platform']
+    list_display = ['token', 'platform', 'is_active']
+    list_filter = ['platform', 'is_active']
     search_fields = ['token']
\ No newline at end of file
@@ -1,71 +1,188 @@
 import asyncio
+import hashlib
 import logging
+import os
+import threading
+from functools import lru_cache
 from django.conf import settings
-from kalyke import ApnsClient, Payload, PayloadAlert
 from django.apps import apps
-from django.core.exceptions import ObjectDoesNotExist
-from firebase_admin import messaging
+from django.core.cache import cache
 from celery import shared_task
 
 
 
 logger = logging.getLogger(__name__)
 
-# Initialize APNs Client with required configurations
-apns_client = ApnsClient(
-    use_sandbox=settings.APNS_USE_SANDBOX,
-    team_id=settings.APNS_TEAM_ID,
-    auth_key_id=settings.APNS_AUTH_KEY_ID,
-    auth_key_filepath=settings.APNS_AUTH_KEY_FILEPATH,
-)
+# kalyke and firebase_admin take a few hundred ms to import, so they are only
+# loaded (and their clients built) the first time a push is actually sent
+_clients_lock = threading.Lock()
+_apns_client = None
+_firebase_app = None
+
+
+def get_apns_client():
+    """
+    The process-wide APNs client, built on first use.
+    """
+    global _apns_client
+    if _apns_client is None:
+        with _clients_lock:
+            if _apns_client is None:
+                from kalyke import ApnsClient
+
+                _apns_client = ApnsClient(
+                    use_sandbox=settings.APNS_USE_SANDBOX,
+                    team_id=settings.APNS_TEAM_ID,
+                    auth_key_id=settings.APNS_AUTH_KEY_ID,
+                    auth_key_filepath=settings.APNS_AUTH_KEY_FILEPATH,
+                )
+    return _apns_client
+
+
+def get_firebase_app():
+    """
+    The process-wide Firebase app, initialized on first use from
+    FCM_CREDENTIALS_PATH (or the environment's default credentials).
+    """
+    global _firebase_app
+    if _firebase_app is None:
+        with _clients_lock:
+            if _firebase_app is None:
+                import firebase_admin
+                from firebase_admin import credentials
+
+                try:
+                    _firebase_app = firebase_admin.get_app()
+                except ValueError:
+                    credential = None
+                    if os.path.exists(settings.FCM_CREDENTIALS_PATH):
+                        credential = credentials.Certificate(settings.FCM_CREDENTIALS_PATH)
+                    _firebase_app = firebase_admin.initialize_app(credential)
+    return _firebase_app
+
+
+def warm_up_push_clients():
+    """
+    Builds both clients ahead of the first send; meant for worker startup, so
+    a misconfiguration is logged rather than raised.
+    """
+    try:
+        get_apns_client()
+        get_firebase_app()
+        _dead_token_errors()
+    except Exception:
+        logger.warning("Could not initialize the push notification clients", exc_info=True)
+
+
+def apns_config():
+    from kalyke import ApnsConfig
+
+    return ApnsConfig(topic=settings.APNS_BUNDLE_ID)
+
 
 def create_payload(title, message):
     """
     Creates a PayloadAlert and Payload for APNs.
     """
+    from kalyke import Payload, PayloadAlert
+
     alert = PayloadAlert(title=title, body=message)
     payload = Payload(alert=alert, sound="default", badge=1)
     return payload
 
+
+@lru_cache(maxsize=None)
+def _dead_token_errors():
+    """
+    Errors meaning the token will never work again (app uninstalled, token
+    rotated or issued for another app), as opposed to transient failures.
+    """
+    from firebase_admin import messaging
+    from kalyke import exceptions as apns_exceptions
+
+    return (
+        apns_exceptions.Unregistered,
+        apns_exceptions.BadDeviceToken,
+        apns_exceptions.DeviceTokenNotForTopic,
+        apns_exceptions.ExpiredToken,
+        messaging.UnregisteredError,
+        messaging.SenderIdMismatchError,
+    )
+
+
+def is_dead_token_error(error):
+    return isinstance(error, _dead_token_errors())
+
+
+def _seen_key(token, platform):
+    return "device-token:seen:" + hashlib.sha1(f"{platform}:{token}".encode()).hexdigest()
+
+
+def register_device_tokens(registrations):
+    """
+    Upserts {token: platform}, skipping tokens already registered within
+    DEVICE_TOKEN_TOUCH_INTERVAL so apps re-registering on every launch don't
+    turn into a write each. Returns how many tokens were written.
+    """
+    fresh = {
+        token: platform for token, platform in registrations.items()
+        if cache.add(_seen_key(token, platform), 1, settings.DEVICE_TOKEN_TOUCH_INTERVAL)
+    }
+    if fresh:
+        DeviceToken = apps.get_model('api.DeviceToken')
+        DeviceToken.objects.upsert(fresh)
+    return len(fresh)
+
+
+def prune_device_tokens(tokens):
+    """
+    Deactivates the given tokens so broadcasts skip them; they come back to
+    life if the app registers them again. Returns how many were pruned.
+    """
+    tokens = list(tokens)
+    if not tokens:
+        return 0
+    DeviceToken = apps.get_model('api.DeviceToken')
+    pruned = DeviceToken.objects.filter(token__in=tokens, is_active=True)
+    # Forget recent registrations so the next one reactivates the token
+    cache.delete_many([
+        _seen_key(token, platform) for token, platform in pruned.values_list('token', 'platform')
+    ])
+    return pruned.update(is_active=False)
+
+
+def _handle_send_error(token, error):
+    if is_dead_token_error(error):
+        prune_device_tokens([token])
+    else:
+        logger.warning("Push to %s failed: %r", token, error)
+
+
 @shared_task
 def send_ios_push_notification(token, title, message):
     payload = create_payload(title, message)
     try:
-        response = apns_client.send_push(token=token, payload=payload)
-        if response.status_code == 200:
-            return True
-        return False
+        asyncio.run(get_apns_client().send_message(
+            device_token=token,
+            payload=payload,
+            apns_config=apns_config(),
+        ))
+        return True
     except Exception as e:
+        _handle_send_error(token, e)
         return False
 
 @shared_task
 def send_android_push_notification(token, title, message):
+    from firebase_admin import messaging
+
     try:
         message = messaging.Message(
             notification=messaging.Notification(title=title, body=message),
             token=token,
         )
-        messaging.send(message)
+        messaging.send(message, app=get_firebase_app())
         return True
-    except Exception:
+    except Exception as e:
+        _handle_send_error(token, e)
         return False
-    
-
-async def send_notifications_to_tokens(tokens, title, message):
-    """
-    Sends push notifications to a list of device tokens.
-    """
-    tasks = [send_ios_push_notification(token, title, message) for token in tokens]
-    return await asyncio.gather(*tasks)
-
-def send_notification_to_all_devices(title, message):
-    DeviceToken = apps.get_model('api.DeviceToken')
-    tokens = DeviceToken.objects.values_list('token', 'platform')
-
-    for token, platform in tokens:
-        if platform == 'ios':
-            send_ios_push_notification.delay(token, title, message)
-        elif platform == 'android':
-            send_android_push_notification.delay(token, title, message)
-
-
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+from datetime import timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .apns import (
+    apns_config,
+    create_payload,
+    get_apns_client,
+    get_firebase_app,
+    is_dead_token_error,
+    prune_device_tokens,
+)
+from .models import Alert, DeviceToken
+
+logger = logging.getLogger(__name__)
+
+# FCM accepts at most 500 tokens per multicast request
+FCM_BATCH_SIZE = 500
+APNS_BATCH_SIZE = 1000
+# Sent in this order, which is also the order the alert cursor moves through
+PLATFORMS = ('android', 'ios')
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def _tokens(platform, batch_size, after_id=None):
+    """
+    Streams the platform's (id, token) pairs in id order and in batches,
+    without loading the table; starts after `after_id` when resuming.
+    """
+    tokens = DeviceToken.objects.filter(platform=platform, is_active=True)
+    if after_id is not None:
+        tokens = tokens.filter(id__gt=after_id)
+    return _chunks(tokens.order_by('id').values_list('id', 'token').iterator(chunk_size=batch_size), batch_size)
+
+
+def send_fcm_batch(tokens, title, message):
+    """
+    One multicast request for up to 500 tokens. Returns [(token, error)],
+    error being None for delivered messages.
+    """
+    from firebase_admin import messaging
+    from firebase_admin.exceptions import FirebaseError
+
+    multicast = messaging.MulticastMessage(
+        tokens=tokens,
+        notification=messaging.Notification(title=title, body=message),
+    )
+    try:
+        response = messaging.send_each_for_multicast(multicast, app=get_firebase_app())
+    except (FirebaseError, ValueError) as e:
+        logger.warning("FCM multicast of %s tokens failed", len(tokens), exc_info=True)
+        return [(token, e) for token in tokens]
+    return [(token, result.exception) for token, result in zip(tokens, response.responses)]
+
+
+class APNsSender:
+    """
+    Sends to APNs over one HTTP/2 connection, at most `concurrency` requests
+    in flight. kalyke's send_message() opens a connection per call, so this
+    drives its client/url/error helpers directly.
+    """
+
+    def __init__(self, client=None, concurrency=None):
+        self.client = client or get_apns_client()
+        self.concurrency = concurrency or settings.APNS_CONCURRENCY
+        self.loop = asyncio.new_event_loop()
+        self.http = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.http is not None:
+            self.loop.run_until_complete(self.http.aclose())
+        self.loop.close()
+
+    async def _send_one(self, semaphore, token, data):
+        import httpx
+
+        async with semaphore:
+            try:
+                response = await self.client._send(
+                    client=self.http, url=self.client._make_url(device_token=token), data=data
+                )
+            except httpx.HTTPError as e:
+                return token, e
+        if response.is_success:
+            return token, None
+        try:
+            return token, self.client._handle_error(error_json=response.json())
+        except (ValueError, KeyError, AttributeError) as e:
+            return token, e
+
+    async def _send_all(self, tokens, data):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        return await asyncio.gather(*(self._send_one(semaphore, token, data) for token in tokens))
+
+    def send_batch(self, tokens, title, message):
+        """
+        Returns [(token, error)], error being None for delivered messages.
+        """
+        data = create_payload(title, message).dict()
+        if self.http is None:
+            try:
+                self.http = self.client._init_client(apns_config=apns_config())
+            except (OSError, ValueError) as e:
+                logger.warning("Could not open the APNs connection", exc_info=True)
+                return [(token, e) for token in tokens]
+        # Database reads stay outside the loop; only the sends run inside it
+        return self.loop.run_until_complete(self._send_all(tokens, data))
+
+
+class AlertReclaimed(Exception):
+    """
+    Another worker took over the broadcast after it looked stalled.
+    """
+
+
+def stalled_alerts():
+    """
+    Alerts left sending by a worker that stopped reporting progress.
+    """
+    stale = timezone.now() - timedelta(seconds=settings.ALERT_STALL_TIMEOUT)
+    return Q(status=Alert.SENDING) & (Q(heartbeat_at__lt=stale) | Q(heartbeat_at__isnull=True))
+
+
+def _record_results(alert, platform, last_token_id, results):
+    """
+    Prunes the dead tokens in one batch and, in one update, adds the batch
+    to the alert's counters, moves its cursor past the batch and beats its
+    heartbeat. Returns (sent, failed, pruned).
+    """
+    dead = [token for token, error in results if error is not None and is_dead_token_error(error)]
+    pruned = prune_device_tokens(dead)
+    failed = sum(1 for _, error in results if error is not None)
+    if alert is not None:
+        heartbeat = timezone.now()
+        # The heartbeat we last wrote is our claim on the alert
+        updated = Alert.objects.filter(pk=alert.pk, status=Alert.SENDING, heartbeat_at=alert.heartbeat_at).update(
+            sent_count=F('sent_count') + len(results) - failed,
+            failed_count=F('failed_count') + failed,
+            pruned_count=F('pruned_count') + pruned,
+            last_platform=platform,
+            last_token_id=last_token_id,
+            heartbeat_at=heartbeat,
+        )
+        if not updated:
+            raise AlertReclaimed(alert.pk)
+        alert.heartbeat_at = heartbeat
+    return len(results) - failed, failed, pruned
+
+
+def broadcast(title, message, alert=None):
+    """
+    Sends the notification to every active device, batch by batch, pruning
+    tokens the push services report as dead after each batch. With an
+    `alert`, its counters and cursor are kept current and sending starts
+    after the cursor, so a broadcast picked up from a dead worker carries
+    on where it stopped. Returns {'sent': n, 'failed': n, 'pruned': n}.
+    """
+    totals = {'sent': 0, 'failed': 0, 'pruned': 0}
+    resume_platform = alert.last_platform if alert is not None else ''
+
+    def send(platform, batch_size, send_batch):
+        if resume_platform and PLATFORMS.index(platform) < PLATFORMS.index(resume_platform):
+            return
+        after_id = alert.last_token_id if platform == resume_platform else None
+        for batch in _tokens(platform, batch_size, after_id):
+            token_ids, tokens = zip(*batch)
+            results = send_batch(list(tokens), title, message)
+            for key, count in zip(('sent', 'failed', 'pruned'), _record_results(alert, platform, token_ids[-1], results)):
+                totals[key] += count
+
+    send('android', FCM_BATCH_SIZE, send_fcm_batch)
+    with APNsSender() as apns:
+        send('ios', APNS_BATCH_SIZE, apns.send_batch)
+
+    return totals
+
+
+def _claim(alert_id):
+    """
+    Takes a pending alert, or a sending one whose worker stalled, by writing
+    a fresh heartbeat. A new alert starts counting; a resumed one keeps its
+    counters and cursor. Returns the alert, or None when it wasn't claimable.
+    """
+    now = timezone.now()
+    claimed = Alert.objects.filter(Q(status=Alert.PENDING) | stalled_alerts(), pk=alert_id).update(
+        status=Alert.SENDING,
+        heartbeat_at=now,
+        finished_at=None,
+    )
+    if not claimed:
+        return None
+    Alert.objects.filter(pk=alert_id, started_at__isnull=True).update(
+        started_at=now,
+        total_count=DeviceToken.objects.filter(is_active=True).count(),
+    )
+    return Alert.objects.get(pk=alert_id)
+
+
+def broadcast_alert(alert_id):
+    """
+    Broadcasts a pending alert, tracking its progress on the row as it goes.
+    The switch to sending is the claim, so an alert queued twice is still
+    sent once. Returns the totals, or None when it wasn't claimable or was
+    taken over mid-way.
+    """
+    alert = _claim(alert_id)
+    if alert is None:
+        return None
+    ours = Alert.objects.filter(pk=alert.pk, status=Alert.SENDING)
+    try:
+        totals = broadcast(alert.title, alert.message, alert=alert)
+    except AlertReclaimed:
+        logger.warning("Alert %s was taken over by another worker", alert.pk)
+        return None
+    except Exception:
+        ours.filter(heartbeat_at=alert.heartbeat_at).update(status=Alert.FAILED, finished_at=timezone.now())
+        raise
+    ours.filter(heartbeat_at=alert.heartbeat_at).update(status=Alert.SENT, is_sent=True, finished_at=timezone.now())
+    logger.info("Alert %s broadcast: %s", alert.pk, totals)
+    return totals
@@ -0,0 +1,167 @@
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+
+def _version_key(model):
+    return f"catalog:version:{model._meta.label_lower}"
+
+
+def _cart_version_key(cart_id):
+    # Clients may send the UUID in any spelling; versions must share one key
+    try:
+        cart_id = uuid.UUID(str(cart_id))
+    except ValueError:
+        pass
+    return f"cart:version:{cart_id}"
+
+
+def _get_versions(keys, timeout=None):
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        now = time.time_ns()
+        for key in missing:
+            cache.add(key, now, timeout=timeout)
+        # Re-read so concurrent workers agree on whichever value won the add()
+        versions.update(cache.get_many(missing))
+    return tuple(versions.get(key, 0) for key in keys)
+
+
+def get_catalog_versions(models):
+    """
+    Returns the current catalog version of each model, in the given order.
+    A version is the time (in ns) of the last change seen for that model.
+    """
+    return _get_versions([_version_key(model) for model in models])
+
+
+def bump_catalog_version(model):
+    """
+    Marks every cached payload that depends on `model` as stale.
+    """
+    cache.set(_version_key(model), time.time_ns(), timeout=None)
+
+
+SUGGESTION_VERSION_KEY = "suggest:version"
+
+
+def get_suggestion_version():
+    """
+    A counter bumped only when a product's title, brand or existence
+    changes, so stock and price edits don't touch the suggestion index.
+    """
+    return _get_versions([SUGGESTION_VERSION_KEY])[0]
+
+
+def bump_suggestion_version():
+    """
+    Returns the new version; the one before it is always one less.
+    """
+    try:
+        return cache.incr(SUGGESTION_VERSION_KEY)
+    except ValueError:
+        # Expired or flushed: restart from a fresh time so no old value returns
+        get_suggestion_version()
+        return cache.incr(SUGGESTION_VERSION_KEY)
+
+
+def get_cart_version(cart_id):
+    """
+    Cart ids come from clients, so only call this for carts that exist; the
+    version expires like a cache cart instead of piling up.
+    """
+    return _get_versions([_cart_version_key(cart_id)], timeout=settings.CART_SESSION_TIMEOUT)[0]
+
+
+def bump_cart_version(cart_id):
+    cache.set(_cart_version_key(cart_id), time.time_ns(), timeout=settings.CART_SESSION_TIMEOUT)
+
+
+def delete_cart_versions(cart_ids):
+    cache.delete_many([_cart_version_key(cart_id) for cart_id in cart_ids])
+
+
+def make_etag(*parts):
+    raw = "|".join(str(part) for part in parts)
+    return '"%s"' % hashlib.sha1(raw.encode()).hexdigest()
+
+
+def last_modified_from(versions):
+    """
+    Versions are change timestamps, so the newest one is the Last-Modified time.
+    """
+    return max(versions, default=0) // 1_000_000_000
+
+
+def set_validators(response, etag, last_modified):
+    response.headers["ETag"] = etag
+    response.headers["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+def not_modified_response(request, etag, last_modified):
+    """
+    Returns a bodiless 304 (or 412) when the request's preconditions match,
+    otherwise None so the caller renders the full response.
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+class CatalogCacheMixin:
+    """
+    Serves list/retrieve payloads from the cache until one of `cache_models`
+    changes. The key embeds the current version of every dependency, so a
+    version bump makes old entries unreachable and they simply expire.
+    The same versions back the ETag/Last-Modified validators, so a
+    conditional GET is answered with a 304 before touching the database.
+    """
+    cache_models = ()
+
+    def get_catalog_versions(self):
+        return get_catalog_versions(self.cache_models)
+
+    def get_response_cache_key(self, request, versions):
+        raw = "|".join([
+            self.__class__.__name__,
+            self.action or "",
+            request.build_absolute_uri(),
+            *(str(version) for version in versions),
+        ])
+        return "catalog:response:" + hashlib.sha1(raw.encode()).hexdigest()
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        versions = self.get_catalog_versions()
+        key = self.get_response_cache_key(request, versions)
+        # The rendered body also depends on the negotiated media type
+        etag = make_etag(key, request.accepted_media_type)
+        last_modified = last_modified_from(versions)
+
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        data = cache.get(key)
+        if data is not None:
+            return set_validators(Response(data), etag, last_modified)
+
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, settings.CATALOG_CACHE_TIMEOUT)
+            set_validators(response, etag, last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
@@ -0,0 +1,288 @@
+import logging
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .caching import delete_cart_versions
+from .models import Cart, CartItem, Coupon, Product
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_cart_id(cart_id):
+    try:
+        return uuid.UUID(str(cart_id))
+    except ValueError:
+        return None
+
+
+class CartLocked(Exception):
+    """
+    Another request kept the cart locked for longer than the store waits.
+    """
+
+
+class BaseCartStore(ABC):
+    """
+    Where anonymous carts live until they are ordered.
+
+    Carts come back from load() with everything CartSerializer and
+    calculate_total() read already in memory.
+    """
+
+    @abstractmethod
+    def exists(self, cart_id):
+        pass
+
+    @abstractmethod
+    def load(self, cart_id):
+        """
+        Returns the cart or None when it doesn't exist (or has expired).
+        """
+
+    @abstractmethod
+    def set_items(self, cart_id, lines):
+        """
+        Upserts {product_id: quantity} into the cart, creating a new cart when
+        cart_id is None. Returns the cart id, or None when cart_id names no
+        cart (any more).
+        """
+
+    @abstractmethod
+    def set_coupon(self, cart, coupon):
+        pass
+
+    @abstractmethod
+    def delete(self, cart):
+        """
+        Removes the cart once the current transaction commits.
+        """
+
+    @abstractmethod
+    @contextmanager
+    def checkout(self, cart_id):
+        """
+        Yields the cart held exclusively for placing an order, or None when it
+        doesn't exist or another checkout already holds it. Must be entered
+        inside transaction.atomic().
+        """
+
+
+class DatabaseCartStore(BaseCartStore):
+    """
+    Carts as Cart/CartItem rows.
+    """
+
+    def exists(self, cart_id):
+        cart_id = _parse_cart_id(cart_id)
+        return cart_id is not None and Cart.objects.filter(cart_id=cart_id).exists()
+
+    def load(self, cart_id):
+        cart_id = _parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        return Cart.objects.with_contents().filter(cart_id=cart_id).first()
+
+    def set_items(self, cart_id, lines):
+        with transaction.atomic():
+            if cart_id is None:
+                cart = Cart.objects.create()
+            else:
+                cart = Cart.objects.only('pk', 'cart_id').filter(cart_id=_parse_cart_id(cart_id)).first()
+                if cart is None:
+                    return None
+            CartItem.objects.bulk_create(
+                [
+                    CartItem(cart=cart, product_id=product_id, quantity=quantity)
+                    for product_id, quantity in lines.items()
+                ],
+                update_conflicts=True,
+                unique_fields=['cart', 'product'],
+                update_fields=['quantity'],
+            )
+        return cart.cart_id
+
+    def set_coupon(self, cart, coupon):
+        cart.applied_coupon = coupon
+        cart.save(update_fields=['applied_coupon'])
+
+    def delete(self, cart):
+        # Rolled back with the rest of the checkout
+        cart.delete()
+
+    @contextmanager
+    def checkout(self, cart_id):
+        cart_id = _parse_cart_id(cart_id)
+        if cart_id is None:
+            yield None
+            return
+        # The coupon join is nullable, so lock only the cart row
+        yield Cart.objects.select_for_update(of=('self',)).with_contents().filter(cart_id=cart_id).first()
+
+
+class SessionCartItems(list):
+    """
+    Stands in for the prefetched `cart.items` manager.
+    """
+
+    def all(self):
+        return self
+
+
+class SessionCart:
+    """
+    A cart held in the cache. It offers what CartSerializer and the checkout
+    views use on Cart; its items are unsaved CartItem instances.
+    """
+    id = None
+    calculate_total = Cart.calculate_total
+
+    def __init__(self, cart_id, items, applied_coupon=None):
+        self.cart_id = cart_id
+        self.items = SessionCartItems(items)
+        self.applied_coupon = applied_coupon
+
+    def __str__(self):
+        return f"السلة {self.cart_id}"
+
+
+class CacheCartStore(BaseCartStore):
+    """
+    Carts as one cache entry each, {'items': {product_id: quantity},
+    'coupon': coupon_id}, expiring CART_SESSION_TIMEOUT seconds after the last
+    change. Nothing touches SQL until the cart is ordered.
+
+    Every read-modify-write of an entry happens under a short cache lock, so
+    concurrent add-to-cart requests don't overwrite each other's lines.
+    """
+    checkout_timeout = 60
+    # How long a writer may hold a cart, and how long others wait for it
+    lock_timeout = 5
+
+    def _key(self, cart_id):
+        return f"cart:session:{cart_id}"
+
+    def _read(self, cart_id):
+        cart_id = _parse_cart_id(cart_id)
+        if cart_id is None:
+            return None, None
+        return cart_id, cache.get(self._key(cart_id))
+
+    def _write(self, cart_id, data):
+        cache.set(self._key(cart_id), data, settings.CART_SESSION_TIMEOUT)
+
+    @contextmanager
+    def _locked(self, cart_id):
+        lock_key = f"cart:lock:{cart_id}"
+        deadline = time.monotonic() + self.lock_timeout
+        while not cache.add(lock_key, 1, self.lock_timeout):
+            if time.monotonic() > deadline:
+                raise CartLocked(cart_id)
+            time.sleep(0.01)
+        try:
+            yield
+        finally:
+            cache.delete(lock_key)
+
+    def exists(self, cart_id):
+        return self._read(cart_id)[1] is not None
+
+    def load(self, cart_id):
+        cart_id, data = self._read(cart_id)
+        if data is None:
+            return None
+        # Products deleted since they were added simply drop out of the cart
+        products = Product.objects.with_details().in_bulk(data['items'])
+        items = [
+            CartItem(product=products[product_id], quantity=quantity)
+            for product_id, quantity in data['items'].items()
+            if product_id in products
+        ]
+        coupon = Coupon.objects.filter(pk=data['coupon']).first() if data['coupon'] else None
+        return SessionCart(cart_id, items, coupon)
+
+    def set_items(self, cart_id, lines):
+        if cart_id is None:
+            cart_id = uuid.uuid4()
+            self._write(cart_id, {'items': dict(lines), 'coupon': None})
+            return cart_id
+        cart_id = _parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        with self._locked(cart_id):
+            _, data = self._read(cart_id)
+            if data is None:
+                return None
+            data['items'].update(lines)
+            self._write(cart_id, data)
+        return cart_id
+
+    def set_coupon(self, cart, coupon):
+        cart.applied_coupon = coupon
+        with self._locked(cart.cart_id):
+            data = cache.get(self._key(cart.cart_id)) or {
+                'items': {item.product.pk: item.quantity for item in cart.items},
+            }
+            data['coupon'] = coupon.pk if coupon else None
+            self._write(cart.cart_id, data)
+
+    def delete(self, cart):
+        # Not before the order commits, so a failed checkout keeps the cart
+        transaction.on_commit(partial(cache.delete, self._key(cart.cart_id)))
+
+    @contextmanager
+    def checkout(self, cart_id):
+        cart_id = _parse_cart_id(cart_id)
+        lock_key = f"cart:checkout:{cart_id}"
+        # Stands in for the row lock: a second concurrent checkout sees no cart
+        if cart_id is None or not cache.add(lock_key, 1, self.checkout_timeout):
+            yield None
+            return
+        try:
+            yield self.load(cart_id)
+        finally:
+            cache.delete(lock_key)
+
+
+def get_cart_store():
+    return import_string(settings.CART_STORE)()
+
+
+def reap_abandoned_carts(max_age=None, batch_size=1000):
+    """
+    Deletes database carts (and their items) created more than `max_age` ago,
+    oldest first, `batch_size` carts per transaction so no lock is held for
+    long. Returns {model label: rows deleted}.
+
+    CacheCartStore carts expire on their own and are not touched.
+    """
+    if max_age is None:
+        max_age = timedelta(days=settings.ABANDONED_CART_DAYS)
+    cutoff = timezone.now() - max_age
+    removed = {Cart._meta.label: 0, CartItem._meta.label: 0}
+    while True:
+        batch = list(
+            Cart.objects.filter(created_at__lt=cutoff)
+            .order_by('created_at', 'id')
+            .values_list('id', 'cart_id')[:batch_size]
+        )
+        if not batch:
+            break
+        with transaction.atomic():
+            _, counts = Cart.objects.filter(pk__in=[pk for pk, _ in batch]).delete()
+        for label, count in counts.items():
+            removed[label] = removed.get(label, 0) + count
+        delete_cart_versions(cart_id for _, cart_id in batch)
+        if len(batch) < batch_size:
+            break
+    logger.info("Reaped abandoned carts older than %s: %s", cutoff, removed)
+    return removed
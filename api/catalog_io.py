@@ -0,0 +1,412 @@
+import csv
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+from functools import partial
+from io import BytesIO
+from urllib.parse import urlparse
+
+import requests
+from django.core.exceptions import SuspiciousFileOperation, ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+from .broadcast import _chunks
+from .caching import bump_catalog_version, bump_suggestion_version
+from .models import Product, ProductImage, SubSection, brand
+from .search import get_search_backend
+from .tasks import enqueue_image_variants
+
+logger = logging.getLogger(__name__)
+
+# Column order of exported files; imports accept any subset that names a
+# product (title, price, quantity, sub_section)
+COLUMNS = [
+    'id', 'sku', 'title', 'price', 'quantity', 'description', 'discount_type',
+    'discount_value', 'is_favoured', 'brand', 'section', 'sub_section', 'images',
+]
+# Written on update; created_at and the keys themselves are left alone
+WRITE_FIELDS = [
+    'title', 'price', 'quantity', 'description', 'discount_type', 'discount_value',
+    'is_favoured', 'brand', 'sub_section',
+]
+# Several images share one CSV cell
+IMAGE_SEPARATOR = '|'
+
+DISCOUNT_TYPES = {
+    Product.FIXED: Product.FIXED,
+    Product.PERCENTAGE: Product.PERCENTAGE,
+    'fixed': Product.FIXED,
+    'percentage': Product.PERCENTAGE,
+}
+FAVOURED = {
+    'نعم': Product.IsFavoured.YES, 'yes': Product.IsFavoured.YES, 'true': Product.IsFavoured.YES,
+    '1': Product.IsFavoured.YES,
+    'لا': Product.IsFavoured.NO, 'no': Product.IsFavoured.NO, 'false': Product.IsFavoured.NO,
+    '0': Product.IsFavoured.NO, '': Product.IsFavoured.NO,
+}
+
+
+class RowError(ValueError):
+    pass
+
+
+def detect_format(path, file_format=None):
+    if file_format:
+        return file_format
+    if path.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    if path.endswith('.csv'):
+        return 'csv'
+    raise ValueError(f"Can't tell the format of {path}; pass --format csv or jsonl.")
+
+
+def read_rows(stream, file_format):
+    """
+    Yields (line number, row) one at a time; JSONL rows are still text.
+    """
+    if file_format == 'csv':
+        yield from enumerate(csv.DictReader(stream), start=2)
+        return
+    for number, line in enumerate(stream, start=1):
+        if line.strip():
+            yield number, line
+
+
+def _verify_image(content):
+    try:
+        with Image.open(BytesIO(content)) as image:
+            image.verify()
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ValueError(f"not an image ({e})")
+
+
+def _text(value):
+    return '' if value is None else str(value).strip()
+
+
+class CatalogImporter:
+    """
+    Upserts products from rows of a supplier feed, `batch_size` rows per
+    transaction. Rows with a sku are matched on it, rows with only an id
+    update that product, and the rest are created.
+
+    Brands and sub-sections are looked up by name from maps loaded once; a
+    brand that doesn't exist yet is created in the batch's transaction, and
+    only for rows that are written. Images (URLs, storage names or
+    local paths) are fetched by a thread pool before each batch's
+    transaction opens, so no lock waits on the network.
+
+    Bulk writes send no signals, so the search index is updated per batch
+    and the catalog and suggestion versions are bumped once at the end.
+    """
+
+    def __init__(self, batch_size=1000, fetch_workers=8, images_dir=None, timeout=20):
+        self.batch_size = batch_size
+        self.fetch_workers = fetch_workers
+        self.images_dir = images_dir
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=fetch_workers, pool_maxsize=fetch_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.search_backend = get_search_backend()
+
+        self.brands = {}
+        for pk, name in brand.objects.order_by('-pk').values_list('pk', 'brand_name'):
+            if name:
+                self.brands[name.strip()] = pk
+        # A bare sub-section name only resolves when no two sections share it
+        self.sub_sections, self.sub_sections_by_name = {}, {}
+        for pk, name, section_name in SubSection.objects.values_list('pk', 'name', 'section__name'):
+            self.sub_sections[(section_name.strip(), name.strip())] = pk
+            self.sub_sections_by_name[name.strip()] = None if name.strip() in self.sub_sections_by_name else pk
+
+        self.stats = {'created': 0, 'updated': 0, 'images': 0, 'skipped': 0}
+        self.errors = []
+
+    def run(self, rows):
+        try:
+            for batch in _chunks(rows, self.batch_size):
+                self._import_batch(batch)
+        finally:
+            # Even after a failure, the batches already committed are live
+            for model in (Product, ProductImage, brand):
+                bump_catalog_version(model)
+            bump_suggestion_version()
+        return self.stats
+
+    def _error(self, number, message):
+        self.errors.append((number, message))
+        self.stats['skipped'] += 1
+
+    def _assign_brands(self, products):
+        """
+        Points the products at their brands, creating the missing ones. Runs
+        inside the batch's transaction, so a batch that fails leaves no new
+        brands behind; returns the created {name: pk} to keep once it commits.
+        """
+        created = {}
+        for product in products:
+            name = product._import_brand
+            if not name:
+                continue
+            if name not in self.brands and name not in created:
+                created[name] = brand.objects.create(brand_name=name).pk
+            product.brand_id = self.brands.get(name) or created[name]
+        return created
+
+    def _sub_section_id(self, section_name, name):
+        if section_name:
+            pk = self.sub_sections.get((section_name, name))
+        else:
+            pk = self.sub_sections_by_name.get(name)
+            if pk is None and name in self.sub_sections_by_name:
+                raise RowError(f"sub_section {name!r} exists in several sections; add a section column.")
+        if pk is None:
+            raise RowError(f"No sub_section {name!r}.")
+        return pk
+
+    def parse(self, row):
+        """
+        Returns (unsaved Product, [image references]) or raises RowError.
+        """
+        if isinstance(row, str):
+            try:
+                row = json.loads(row)
+            except ValueError as e:
+                raise RowError(f"Invalid JSON: {e}")
+            if not isinstance(row, dict):
+                raise RowError("Each line must be a JSON object.")
+        try:
+            price = Decimal(_text(row.get('price')))
+            discount_value = _text(row.get('discount_value'))
+            discount_value = Decimal(discount_value) if discount_value else None
+            quantity = int(_text(row.get('quantity')) or 0)
+            product_id = int(_text(row.get('id'))) if _text(row.get('id')) else None
+        except (InvalidOperation, ValueError):
+            raise RowError("price, discount_value, quantity and id must be numbers.")
+        discount_type = _text(row.get('discount_type')).lower()
+        if discount_type and discount_type not in DISCOUNT_TYPES:
+            raise RowError(f"Unknown discount_type {discount_type!r}.")
+        favoured = _text(row.get('is_favoured')).lower()
+        if favoured not in FAVOURED:
+            raise RowError(f"Unknown is_favoured {favoured!r}.")
+
+        product = Product(
+            pk=product_id,
+            sku=_text(row.get('sku')) or None,
+            title=_text(row.get('title')),
+            price=price,
+            quantity=quantity,
+            description=_text(row.get('description')) or None,
+            discount_type=DISCOUNT_TYPES.get(discount_type),
+            discount_value=discount_value,
+            is_favoured=FAVOURED[favoured],
+            sub_section_id=self._sub_section_id(_text(row.get('section')), _text(row.get('sub_section'))),
+        )
+        # Resolved in _import_batch, once the row is known to be written
+        product._import_brand = _text(row.get('brand'))
+        try:
+            # Foreign keys are already resolved; validating them would query per row
+            product.clean_fields(exclude=['brand', 'sub_section'])
+            product.clean()
+        except ValidationError as e:
+            raise RowError("; ".join(e.messages))
+
+        images = row.get('images') or []
+        if isinstance(images, str):
+            images = images.split(IMAGE_SEPARATOR)
+        return product, [_text(image) for image in images if _text(image)]
+
+    def _local_path(self, reference):
+        """
+        Resolves an absolute or relative path against images_dir; paths that
+        end up outside it are refused.
+        """
+        if not self.images_dir:
+            raise ValueError("local image paths need an images directory")
+        root = os.path.realpath(self.images_dir)
+        path = os.path.realpath(os.path.join(root, reference))
+        if os.path.commonpath([root, path]) != root:
+            raise SuspiciousFileOperation(f"{reference} is outside the images directory")
+        return path
+
+    def fetch_image(self, reference):
+        """
+        Returns the storage name for an image URL, a local path under
+        images_dir, or a relative name already in storage. Downloaded and
+        local files are checked to be images before they are stored.
+        """
+        field = ProductImage._meta.get_field('image')
+        if reference.startswith(('http://', 'https://')):
+            response = self.session.get(reference, timeout=self.timeout)
+            response.raise_for_status()
+            if not response.headers.get('Content-Type', '').startswith('image/'):
+                raise ValueError(f"not an image ({response.headers.get('Content-Type')})")
+            filename = os.path.basename(urlparse(reference).path) or 'image'
+            content = response.content
+        else:
+            if not os.path.isabs(reference) and default_storage.exists(reference):
+                return reference
+            path = self._local_path(reference)
+            filename = os.path.basename(path)
+            with open(path, 'rb') as source:
+                content = source.read()
+        _verify_image(content)
+        return default_storage.save(field.generate_filename(None, filename), ContentFile(content))
+
+    def _fetch_images(self, references):
+        """
+        Returns ({reference: storage name}, {reference: error}) where the
+        errors are references that must fail their rows, such as paths
+        escaping the media root. Other failures only drop the image.
+        """
+        if not references:
+            return {}, {}
+
+        def fetch(reference):
+            try:
+                return reference, self.fetch_image(reference), None, False
+            except (OSError, ValueError, requests.RequestException) as e:
+                return reference, None, str(e), False
+            except SuspiciousFileOperation as e:
+                return reference, None, str(e), True
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as pool:
+            results = list(pool.map(fetch, references))
+        for reference, _, error, _ in results:
+            if error:
+                logger.warning("Could not fetch image %s: %s", reference, error)
+        stored = {reference: name for reference, name, _, _ in results if name}
+        rejected = {reference: error for reference, _, error, suspicious in results if suspicious}
+        return stored, rejected
+
+    def _import_batch(self, batch):
+        parsed = {}
+        for number, row in batch:
+            try:
+                product, images = self.parse(row)
+            except RowError as e:
+                self._error(number, str(e))
+                continue
+            # A sku listed twice in one batch: the last row wins
+            key = ('sku', product.sku) if product.sku else ('row', number)
+            parsed[key] = (number, product, images)
+
+        stored, rejected = self._fetch_images({image for _, _, images in parsed.values() for image in images})
+        for key, (number, _, images) in list(parsed.items()):
+            errors = [f"Image {image!r}: {rejected[image]}" for image in images if image in rejected]
+            if errors:
+                self._error(number, "; ".join(errors))
+                del parsed[key]
+
+        with_sku = [entry for key, entry in parsed.items() if key[0] == 'sku']
+        by_id = [entry for key, entry in parsed.items() if key[0] == 'row' and entry[1].pk]
+        new = [entry for key, entry in parsed.items() if key[0] == 'row' and not entry[1].pk]
+
+        with transaction.atomic():
+            if by_id:
+                known = set(Product.objects.filter(pk__in=[product.pk for _, product, _ in by_id]).values_list('pk', flat=True))
+                for number, product, _ in by_id:
+                    if product.pk not in known:
+                        self._error(number, f"No product with id {product.pk}.")
+                by_id = [entry for entry in by_id if entry[1].pk in known]
+            created_brands = self._assign_brands(product for _, product, _ in with_sku + by_id + new)
+
+            if with_sku:
+                for _, product, _ in with_sku:
+                    # Matched on sku alone; an exported id must not collide on insert
+                    product.pk = None
+                skus = [product.sku for _, product, _ in with_sku]
+                existing = set(Product.objects.filter(sku__in=skus).values_list('sku', flat=True))
+                Product.objects.bulk_create(
+                    [product for _, product, _ in with_sku],
+                    update_conflicts=True,
+                    unique_fields=['sku'],
+                    update_fields=WRITE_FIELDS,
+                )
+                # Not every backend returns ids for upserted rows
+                ids = dict(Product.objects.filter(sku__in=skus).values_list('sku', 'pk'))
+                for _, product, _ in with_sku:
+                    product.pk = ids[product.sku]
+                self.stats['updated'] += len(existing)
+                self.stats['created'] += len(with_sku) - len(existing)
+
+            if by_id:
+                Product.objects.bulk_update([product for _, product, _ in by_id], WRITE_FIELDS)
+                self.stats['updated'] += len(by_id)
+
+            if new:
+                Product.objects.bulk_create([product for _, product, _ in new])
+                self.stats['created'] += len(new)
+
+            written = with_sku + by_id + new
+            product_ids = [product.pk for _, product, _ in written]
+            # Re-importing the same feed doesn't attach the same image again
+            attached = set(ProductImage.objects.filter(product_id__in=product_ids).values_list('product_id', 'image'))
+            images = []
+            for _, product, references in written:
+                for reference in references:
+                    name = stored.get(reference)
+                    if name and (product.pk, name) not in attached:
+                        attached.add((product.pk, name))
+                        images.append(ProductImage(product_id=product.pk, image=name))
+            ProductImage.objects.bulk_create(images)
+            self.stats['images'] += len(images)
+            # bulk_create sends no post_save, so queue the variants here
+            for image in images:
+                transaction.on_commit(partial(enqueue_image_variants, ProductImage, image.pk))
+
+            if self.search_backend is not None:
+                transaction.on_commit(lambda: self.search_backend.index(Product.objects.filter(pk__in=product_ids)))
+        self.brands.update(created_brands)
+
+
+def export_rows(queryset):
+    """
+    Yields one dict per product, in COLUMNS order, without loading the table.
+    """
+    products = (
+        queryset.select_related('brand', 'sub_section__section')
+        .prefetch_related('images').order_by('pk')
+    )
+    for product in products.iterator(chunk_size=2000):
+        yield {
+            'id': product.pk,
+            'sku': product.sku,
+            'title': product.title,
+            'price': str(product.price),
+            'quantity': product.quantity,
+            'description': product.description,
+            'discount_type': product.discount_type,
+            'discount_value': None if product.discount_value is None else str(product.discount_value),
+            'is_favoured': product.is_favoured,
+            'brand': product.brand.brand_name if product.brand else None,
+            'section': product.sub_section.section.name,
+            'sub_section': product.sub_section.name,
+            'images': [image.image.name for image in product.images.all()],
+        }
+
+
+def write_rows(rows, stream, file_format):
+    """
+    Writes the rows as they come; returns how many there were.
+    """
+    count = 0
+    if file_format == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({**row, 'images': IMAGE_SEPARATOR.join(row['images'])})
+            count += 1
+        return count
+    for row in rows:
+        stream.write(json.dumps(row, ensure_ascii=False) + "\n")
+        count += 1
+    return count
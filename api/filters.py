@@ -0,0 +1,38 @@
+import django_filters
+from rest_framework.filters import SearchFilter
+
+from .models import Product
+from .search import get_search_backend
+
+
+class ProductFilter(django_filters.FilterSet):
+    # Needs a queryset annotated with Product.objects.with_effective_price()
+    effective_price__gte = django_filters.NumberFilter(field_name='effective_price', lookup_expr='gte')
+    effective_price__lte = django_filters.NumberFilter(field_name='effective_price', lookup_expr='lte')
+
+    class Meta:
+        model = Product
+        fields = ['title', 'price', 'sub_section', 'brand', 'is_favoured']
+
+
+class ProductSearchFilter(SearchFilter):
+    """
+    Matches `?search=` against the full-text index (see api.search) and orders
+    results by relevance unless the client asked for an explicit `?ordering=`.
+    Falls back to SearchFilter's icontains lookups on databases without one.
+
+    List it after OrderingFilter so the relevance order isn't overwritten by
+    the view's default ordering.
+    """
+    def filter_queryset(self, request, queryset, view):
+        backend = get_search_backend()
+        terms = self.get_search_terms(request)
+        if backend is None or not terms:
+            return super().filter_queryset(request, queryset, view)
+
+        matches = backend.filter_queryset(queryset, ' '.join(terms))
+        if matches is None:
+            return queryset.none()
+        if 'ordering' in request.query_params:
+            return matches
+        return matches.order_by('-search_rank', 'pk')
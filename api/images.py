@@ -0,0 +1,186 @@
+import base64
+import logging
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from PIL import Image, ImageOps
+
+from .caching import bump_catalog_version
+from .models import Banner, ProductImage, Section, SubSection, brand
+
+logger = logging.getLogger(__name__)
+
+# The image field each model serves, and so derives variants from
+IMAGE_FIELDS = {
+    Section: 'image',
+    SubSection: 'image',
+    brand: 'brand_image',
+    ProductImage: 'image',
+    Banner: 'image',
+}
+
+# Format name in image_variants -> (Pillow format, file extension)
+IMAGE_FORMATS = {
+    'webp': ('WEBP', 'webp'),
+    'jpeg': ('JPEG', 'jpg'),
+}
+
+DERIVATIVES_DIR = 'derivatives'
+
+# Bumped when the map gains something, so older maps count as stale
+VARIANTS_VERSION = 2
+
+
+def variant_widths(source_width):
+    """
+    The configured widths, never wider than the source; a source narrower
+    than all of them gets one re-encoded variant at its own width.
+    """
+    return sorted({min(width, source_width) for width in settings.IMAGE_VARIANT_WIDTHS})
+
+
+def _encode(image, width, image_format):
+    pil_format, _ = IMAGE_FORMATS[image_format]
+    height = max(1, round(image.height * width / image.width))
+    resized = image.resize((width, height), Image.LANCZOS) if width != image.width else image.copy()
+    if pil_format == 'JPEG' and resized.mode != 'RGB':
+        # JPEG has no alpha, so flatten transparent logos onto white
+        background = Image.new('RGB', resized.size, 'white')
+        if resized.mode in ('RGBA', 'LA'):
+            background.paste(resized, mask=resized.getchannel('A'))
+        else:
+            background.paste(resized.convert('RGB'))
+        resized = background
+    buffer = BytesIO()
+    # Nothing from the source's info (EXIF, ICC, comments) is passed on
+    resized.save(buffer, pil_format, quality=settings.IMAGE_VARIANT_QUALITY, optimize=pil_format == 'JPEG')
+    return buffer.getvalue()
+
+
+def build_placeholder(image):
+    """
+    What a client paints before the image arrives: the dominant colour and a
+    tiny blurred WebP inlined as a data URI, a few hundred bytes in all.
+    """
+    small = image.copy()
+    small.thumbnail((64, 64))
+    if small.mode == 'RGBA':
+        background = Image.new('RGB', small.size, 'white')
+        background.paste(small, mask=small.getchannel('A'))
+        small = background
+    palette = small.quantize(colors=5)
+    _, index = max(palette.getcolors())
+    red, green, blue = palette.getpalette()[index * 3:index * 3 + 3]
+
+    width = min(settings.IMAGE_PLACEHOLDER_WIDTH, image.width)
+    tiny = image.resize((width, max(1, round(image.height * width / image.width))), Image.BILINEAR)
+    buffer = BytesIO()
+    tiny.save(buffer, 'WEBP', quality=30)
+    return {
+        'color': f"#{red:02x}{green:02x}{blue:02x}",
+        'lqip': "data:image/webp;base64," + base64.b64encode(buffer.getvalue()).decode('ascii'),
+    }
+
+
+def build_image_variants(name, storage=default_storage):
+    """
+    Writes resized, metadata-free copies of the image in every format and
+    width and returns the map stored in image_variants:
+    {'source': name, 'width': w, 'height': h, 'placeholder': {...},
+    'webp': {'320': name}, ...}.
+
+    Variants go under DERIVATIVES_DIR, mirroring the source's directory.
+    The hashed default storage names them by their content, so an unchanged
+    variant is never written twice and each name can be cached forever.
+    Touches storage only, never the database, so it can run in a worker
+    process.
+    """
+    try:
+        with storage.open(name, 'rb') as source, Image.open(source) as opened:
+            image = ImageOps.exif_transpose(opened)
+            image.load()
+    except (OSError, Image.DecompressionBombError):
+        logger.warning("Could not build variants of %s", name, exc_info=True)
+        # Recorded with no formats, so a broken upload isn't retried on every save
+        return {'source': name, 'version': VARIANTS_VERSION}
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+    variants = {
+        'source': name,
+        'version': VARIANTS_VERSION,
+        'width': image.width,
+        'height': image.height,
+        'placeholder': build_placeholder(image),
+    }
+    stem = os.path.splitext(name)[0]
+    for image_format, (_, extension) in IMAGE_FORMATS.items():
+        variants[image_format] = {}
+        for width in variant_widths(image.width):
+            content = ContentFile(_encode(image, width, image_format))
+            variants[image_format][str(width)] = storage.save(f"{DERIVATIVES_DIR}/{stem}-{width}w.{extension}", content)
+    return variants
+
+
+def needs_variants(instance):
+    """
+    Whether image_variants was built from some other file than the current
+    one, or by an older version of this module.
+    """
+    field_file = getattr(instance, IMAGE_FIELDS[type(instance)])
+    variants = instance.image_variants or {}
+    if variants.get('source') != (field_file.name or None):
+        return True
+    return bool(field_file) and variants.get('version') != VARIANTS_VERSION
+
+
+def save_image_variants(model, pk, variants):
+    """
+    Stores the variants, but only if the row's image is still the one they
+    were built from. Returns whether the row was updated. Cached catalog
+    pages are left for the caller to expire.
+    """
+    field_name = IMAGE_FIELDS[model]
+    source = variants.get('source')
+    if source:
+        unchanged = Q(**{field_name: source})
+    else:
+        unchanged = Q(**{f"{field_name}__isnull": True}) | Q(**{field_name: ''})
+    return bool(model.objects.filter(unchanged, pk=pk).update(image_variants=variants))
+
+
+def generate_image_variants(model, pk):
+    """
+    Builds and stores the variants of one row's image. Returns the map, or
+    None when the row is gone or its image changed while this ran.
+    """
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None:
+        return None
+    field_file = getattr(instance, IMAGE_FIELDS[model])
+    variants = build_image_variants(field_file.name, field_file.storage) if field_file else {}
+    if not save_image_variants(model, pk, variants):
+        return None
+    # update() sends no post_save, so expire cached catalog pages here
+    bump_catalog_version(model)
+    return variants
+
+
+def variant_urls(variants, request=None, storage=default_storage):
+    """
+    {format: {width: url}} for a serializer; absolute when there is a request.
+    """
+    urls = {}
+    for image_format in IMAGE_FORMATS:
+        names = (variants or {}).get(image_format)
+        if not names:
+            continue
+        urls[image_format] = {}
+        for width, name in names.items():
+            url = storage.url(name)
+            urls[image_format][width] = request.build_absolute_uri(url) if request is not None else url
+    return urls
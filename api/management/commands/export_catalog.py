@@ -0,0 +1,28 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.catalog_io import detect_format, export_rows, write_rows
+from api.models import Product
+
+
+class Command(BaseCommand):
+    help = "Streams every product to a CSV or JSONL file that import_catalog reads back."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The file to write, or - for standard output.")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Defaults to the file extension.")
+
+    def handle(self, *args, **options):
+        try:
+            file_format = detect_format(options['path'], options['format'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        rows = export_rows(Product.objects.all())
+        if options['path'] == '-':
+            write_rows(rows, sys.stdout, file_format)
+            return
+        with open(options['path'], 'w', newline='', encoding='utf-8') as stream:
+            count = write_rows(rows, stream, file_format)
+        self.stdout.write(self.style.SUCCESS(f"Exported {count} products."))
@@ -0,0 +1,48 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.catalog_io import CatalogImporter, detect_format, read_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Upserts products from a CSV or JSONL feed, streaming it row by row "
+        "and writing in batches. Columns: sku, id, title, price, quantity, "
+        "description, discount_type, discount_value, is_favoured, brand, "
+        "section, sub_section, images (URLs, stored names or paths under "
+        "--images-dir, '|'-separated in CSV)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The feed, or - for standard input.")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Defaults to the file extension.")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows per transaction.")
+        parser.add_argument('--fetch-workers', type=int, default=8, help="Images downloaded at once.")
+        parser.add_argument('--images-dir', help="Where local image paths are read from; paths outside it are refused.")
+
+    def handle(self, *args, **options):
+        try:
+            file_format = detect_format(options['path'], options['format'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['batch_size'] < 1 or options['fetch_workers'] < 1:
+            raise CommandError("--batch-size and --fetch-workers must be at least 1.")
+
+        importer = CatalogImporter(
+            batch_size=options['batch_size'],
+            fetch_workers=options['fetch_workers'],
+            images_dir=options['images_dir'],
+        )
+        if options['path'] == '-':
+            stats = importer.run(read_rows(sys.stdin, file_format))
+        else:
+            with open(options['path'], newline='', encoding='utf-8-sig') as stream:
+                stats = importer.run(read_rows(stream, file_format))
+
+        for number, message in importer.errors[:20]:
+            self.stderr.write(f"line {number}: {message}")
+        if len(importer.errors) > 20:
+            self.stderr.write(f"... and {len(importer.errors) - 20} more")
+        self.stdout.write(", ".join(f"{key}: {count}" for key, count in stats.items()))
+        self.stdout.write(self.style.SUCCESS("Done."))
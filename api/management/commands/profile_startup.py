@@ -0,0 +1,84 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Times each startup phase in the child and prints them as JSON on stdout.
+# api.models is imported by django.setup(), so that phase is reported as it.
+STARTUP_CODE = """
+import json, time
+phases = {}
+start = time.perf_counter()
+import django
+from django.conf import settings
+settings.INSTALLED_APPS
+phases['core.settings'] = time.perf_counter() - start
+mark = time.perf_counter()
+django.setup()
+phases['api.models'] = time.perf_counter() - mark
+mark = time.perf_counter()
+import api.views
+phases['api.views'] = time.perf_counter() - mark
+print(json.dumps({name: round(seconds * 1000, 1) for name, seconds in phases.items()}))
+"""
+
+
+def parse_importtime(stderr):
+    """
+    Returns [(module, self_us, cumulative_us, depth)] from `-X importtime`.
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        name = name.rstrip()
+        # One space after the bar, then two more per nesting level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+class Command(BaseCommand):
+    help = "Reports how long a fresh process takes to import settings, models and views."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=15, help="How many of the slowest imports to list.")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON.")
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'core.settings'))
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', STARTUP_CODE],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        wall_ms = (time.perf_counter() - started) * 1000
+        if result.returncode != 0:
+            raise CommandError(result.stderr.strip().splitlines()[-1])
+
+        rows = parse_importtime(result.stderr)
+        report = {
+            'wall_ms': round(wall_ms, 1),
+            'phases_ms': json.loads(result.stdout.strip().splitlines()[-1]),
+            # Top-level imports are the ones worth deferring
+            'slowest_ms': [
+                (name, round(cumulative_us / 1000, 1))
+                for name, _, cumulative_us, depth in sorted(rows, key=lambda row: -row[2])
+                if depth == 0
+            ][:options['top']],
+        }
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(f"Fresh process, start to views imported: {report['wall_ms']} ms")
+        for phase, ms in report['phases_ms'].items():
+            self.stdout.write(f"  {phase:<40} {ms:>8} ms")
+        self.stdout.write("Slowest top-level imports (cumulative):")
+        for name, ms in report['slowest_ms']:
+            self.stdout.write(f"  {name:<40} {ms:>8} ms")
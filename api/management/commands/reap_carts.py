@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.cart_store import reap_abandoned_carts
+
+
+class Command(BaseCommand):
+    help = "Deletes abandoned carts in small batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.ABANDONED_CART_DAYS,
+                            help="Delete carts created more than this many days ago.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        removed = reap_abandoned_carts(
+            max_age=timedelta(days=options['days']),
+            batch_size=options['batch_size'],
+        )
+        for label, count in removed.items():
+            self.stdout.write(f"{label}: {count}")
+        self.stdout.write(self.style.SUCCESS("Done."))
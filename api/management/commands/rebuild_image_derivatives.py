@@ -0,0 +1,101 @@
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+
+# Spawned workers import this module before Django is set up, so nothing
+# that loads models is imported at the top
+def _init_worker():
+    django.setup()
+
+
+def _build_variants(name):
+    from api.images import build_image_variants
+
+    return build_image_variants(name)
+
+
+def _jobs(model, force):
+    """
+    (pk, image name) for every row whose variants are missing or stale.
+    """
+    from api.images import IMAGE_FIELDS, needs_variants
+
+    field_name = IMAGE_FIELDS[model]
+    rows = model.objects.only('pk', field_name, 'image_variants').order_by('pk').iterator(chunk_size=500)
+    for instance in rows:
+        if force or needs_variants(instance):
+            yield instance.pk, getattr(instance, field_name).name or None
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds the resized variants of catalog images across a pool of "
+        "processes. Rows already up to date are skipped, so an interrupted "
+        "run picks up where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help="Processes to resize in; 1 works in this process.")
+        parser.add_argument('--model', action='append', dest='models',
+                            help="Only this model, e.g. api.ProductImage. Repeatable.")
+        parser.add_argument('--force', action='store_true', help="Rebuild up-to-date rows too.")
+
+    def handle(self, *args, **options):
+        from api.caching import bump_catalog_version
+        from api.images import IMAGE_FIELDS, save_image_variants
+
+        models = {model._meta.label_lower: model for model in IMAGE_FIELDS}
+        selected = [label.lower() for label in options['models'] or models]
+        unknown = set(selected) - set(models)
+        if unknown:
+            raise CommandError(f"No images on {', '.join(sorted(unknown))}; choose from {', '.join(models)}.")
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1.")
+
+        for label in selected:
+            model = models[label]
+            built = skipped = 0
+            for pk, variants in self._build(model, options['workers'], options['force']):
+                # Saved as each image finishes, which is what makes the run resumable
+                if save_image_variants(model, pk, variants):
+                    built += 1
+                else:
+                    skipped += 1
+                if (built + skipped) % 100 == 0:
+                    self.stdout.write(f"{label}: {built} built...")
+            if built:
+                bump_catalog_version(model)
+            self.stdout.write(f"{label}: {built} built, {skipped} changed while building")
+        self.stdout.write(self.style.SUCCESS("Done."))
+
+    def _build(self, model, workers, force):
+        """
+        Yields (pk, variants) as images finish, keeping at most a few jobs per
+        worker queued so a large table isn't submitted all at once.
+        """
+        jobs = _jobs(model, force)
+        if workers == 1:
+            for pk, name in jobs:
+                yield pk, _build_variants(name) if name else {}
+            return
+
+        # Spawned rather than forked, so no worker inherits this process's
+        # database connection; workers only touch storage anyway
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as pool:
+            pending = {}
+            for pk, name in jobs:
+                if not name:
+                    yield pk, {}
+                    continue
+                if len(pending) >= workers * 4:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield pending.pop(future), future.result()
+                pending[pool.submit(_build_variants, name)] = pk
+            for future in list(pending):
+                yield pending.pop(future), future.result()
@@ -0,0 +1,41 @@
+import posixpath
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.views.static import serve
+
+from .storage import is_hashed_name
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def media_cache_control(name):
+    """
+    Content-hashed files are cached for a year without revalidation; files
+    still under their upload name only for MEDIA_CACHE_SECONDS.
+    """
+    if is_hashed_name(name):
+        return IMMUTABLE
+    return f"public, max-age={settings.MEDIA_CACHE_SECONDS}"
+
+
+def serve_media(request, path):
+    """
+    Serves an upload with long-lived caching. With MEDIA_ACCEL_REDIRECT set
+    (the internal nginx location aliased to MEDIA_ROOT) the bytes are sent
+    by nginx via X-Accel-Redirect; otherwise Django streams them, answering
+    If-Modified-Since itself. A CDN can front either.
+    """
+    path = posixpath.normpath(path).lstrip('/')
+    if path.startswith('..') or not path or path == '.':
+        raise Http404
+    if settings.MEDIA_ACCEL_REDIRECT:
+        response = HttpResponse()
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT.rstrip('/') + '/' + quote(path)
+        # nginx fills in the type from the file it sends
+        del response['Content-Type']
+    else:
+        response = serve(request, path, document_root=settings.MEDIA_ROOT)
+    response['Cache-Control'] = media_cache_control(path)
+    return response
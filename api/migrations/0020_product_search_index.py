@@ -0,0 +1,94 @@
+import re
+
+from django.db import migrations
+
+# Frozen copies of api.search as of this migration, so later changes there
+# can't alter what it does
+ARABIC_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed]')
+TATWEEL = '\u0640'
+ARABIC_LETTERS = str.maketrans({
+    'أ': 'ا',
+    'إ': 'ا',
+    'آ': 'ا',
+    'ٱ': 'ا',
+    'ى': 'ي',
+    'ة': 'ه',
+})
+
+SQLITE_CREATE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS api_product_fts USING fts5("
+    "title, description, brand_name, sub_section_name, "
+    "tokenize = 'unicode61 remove_diacritics 2')"
+)
+SQLITE_INSERT = (
+    "INSERT INTO api_product_fts (rowid, title, description, brand_name, sub_section_name) "
+    "VALUES (%s, %s, %s, %s, %s)"
+)
+SQLITE_DROP = "DROP TABLE IF EXISTS api_product_fts"
+
+POSTGRES_CREATE = [
+    "CREATE TABLE IF NOT EXISTS api_product_search ("
+    "product_id bigint PRIMARY KEY REFERENCES api_product (id) "
+    "ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+    "document tsvector NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS api_product_search_document_idx "
+    "ON api_product_search USING GIN (document)",
+]
+POSTGRES_INSERT = (
+    "INSERT INTO api_product_search (product_id, document) VALUES (%s, "
+    "setweight(to_tsvector('simple', %s), 'A') || "
+    "setweight(to_tsvector('simple', %s), 'C') || "
+    "setweight(to_tsvector('simple', %s), 'B') || "
+    "setweight(to_tsvector('simple', %s), 'B')) "
+    "ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document"
+)
+POSTGRES_DROP = "DROP TABLE IF EXISTS api_product_search"
+
+
+def normalize_arabic(text):
+    if not text:
+        return ''
+    text = ARABIC_DIACRITICS.sub('', text).replace(TATWEEL, '')
+    return text.translate(ARABIC_LETTERS).lower()
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        create, insert = [SQLITE_CREATE], SQLITE_INSERT
+    elif vendor == 'postgresql':
+        create, insert = POSTGRES_CREATE, POSTGRES_INSERT
+    else:
+        return
+
+    Product = apps.get_model('api', 'Product')
+    rows = Product.objects.values_list(
+        'id', 'title', 'description', 'brand__brand_name', 'sub_section__name'
+    ).order_by('id')
+    with schema_editor.connection.cursor() as cursor:
+        for statement in create:
+            cursor.execute(statement)
+        documents = [
+            (product_id, *(normalize_arabic(field) for field in fields))
+            for product_id, *fields in rows.iterator(chunk_size=2000)
+        ]
+        if documents:
+            cursor.executemany(insert, documents)
+
+
+def drop_search_index(apps, schema_editor):
+    drop = {'sqlite': SQLITE_DROP, 'postgresql': POSTGRES_DROP}.get(schema_editor.connection.vendor)
+    if drop is not None:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(drop)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_product_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.7 on 2026-10-18 04:20
+
+from django.db import migrations, models
+
+
+def remove_duplicate_cart_items(apps, schema_editor):
+    """
+    Keeps the newest row of each (cart, product) pair so the constraint applies.
+    """
+    CartItem = apps.get_model('api', 'CartItem')
+    duplicates = (
+        CartItem.objects.values('cart_id', 'product_id')
+        .annotate(rows=models.Count('id'), newest=models.Max('id'))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates:
+        CartItem.objects.filter(
+            cart_id=duplicate['cart_id'],
+            product_id=duplicate['product_id'],
+        ).exclude(id=duplicate['newest']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_product_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_cart_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='unique_cart_product'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-18 04:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_cartitem_unique_cart_product'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['created_at', 'id'], name='api_cart_created_7a65a4_idx'),
+        ),
+    ]
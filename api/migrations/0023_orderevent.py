@@ -0,0 +1,34 @@
+# Generated by Django 5.1.7 on 2026-10-18 04:26
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_cart_created_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sink', models.CharField(max_length=50, verbose_name='الوجهة')),
+                ('status', models.CharField(choices=[('pending', 'بانتظار الارسال'), ('sent', 'تم الارسال'), ('failed', 'فشل الارسال')], default='pending', max_length=10, verbose_name='الحالة')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='عدد المحاولات')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='موعد المحاولة القادمة')),
+                ('last_error', models.TextField(blank=True, verbose_name='آخر خطأ')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='تاريخ الانشاء')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='تاريخ الارسال')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='api.order', verbose_name='الطلب')),
+            ],
+            options={
+                'verbose_name': 'اشعارات الطلبات',
+                'verbose_name_plural': 'اشعارات الطلبات',
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='api_orderev_status_ab5e1c_idx')],
+            },
+        ),
+    ]
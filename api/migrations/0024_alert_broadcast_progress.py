@@ -0,0 +1,52 @@
+# Generated by Django 5.1.7 on 2026-10-18 04:29
+
+from django.db import migrations, models
+
+
+def mark_existing_alerts(apps, schema_editor):
+    Alert = apps.get_model('api', 'Alert')
+    Alert.objects.filter(is_sent=True).update(status='sent')
+    # Old unsent alerts must not all go out at once on deploy; the admin can
+    # still re-queue any of them
+    Alert.objects.filter(is_sent=False).update(status='failed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0023_orderevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alert',
+            name='failed_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='فشل الارسال الى'),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='انتهى الارسال'),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='sent_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='تم الارسال الى'),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='started_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='بدأ الارسال'),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='status',
+            field=models.CharField(choices=[('pending', 'بانتظار الارسال'), ('sending', 'جاري الارسال'), ('sent', 'تم الارسال'), ('failed', 'فشل الارسال')], default='pending', editable=False, max_length=10, verbose_name='حالة الارسال'),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='total_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='عدد الاجهزة'),
+        ),
+        migrations.RunPython(mark_existing_alerts, migrations.RunPython.noop),
+    ]
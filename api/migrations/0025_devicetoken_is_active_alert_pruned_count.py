@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-18 04:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_alert_broadcast_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alert',
+            name='pruned_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='اجهزة تم تعطيلها'),
+        ),
+        migrations.AddField(
+            model_name='devicetoken',
+            name='is_active',
+            field=models.BooleanField(default=True, help_text='False once APNs/FCM report the token as dead'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.1.7 on 2026-10-18 04:30
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def remove_duplicate_tokens(apps, schema_editor):
+    """
+    Keeps the newest row of each token so the unique index applies.
+    """
+    DeviceToken = apps.get_model('api', 'DeviceToken')
+    duplicates = (
+        DeviceToken.objects.values('token')
+        .annotate(rows=models.Count('id'), newest=models.Max('id'))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates:
+        DeviceToken.objects.filter(token=duplicate['token']).exclude(id=duplicate['newest']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0025_devicetoken_is_active_alert_pruned_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicetoken',
+            name='last_seen_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='Last time the app registered this token'),
+        ),
+        migrations.RunPython(remove_duplicate_tokens, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='devicetoken',
+            name='token',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='devicetoken',
+            index=models.Index(fields=['platform', 'is_active', 'id'], name='api_devicet_platfor_bdf251_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.7 on 2026-10-18 04:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0026_devicetoken_registry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='banner',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='نسخ الصورة'),
+        ),
+        migrations.AddField(
+            model_name='brand',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='نسخ الصورة'),
+        ),
+        migrations.AddField(
+            model_name='productimage',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='نسخ الصورة'),
+        ),
+        migrations.AddField(
+            model_name='section',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='نسخ الصورة'),
+        ),
+        migrations.AddField(
+            model_name='subsection',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='نسخ الصورة'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.7 on 2026-10-18 04:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0028_product_sku'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alert',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='آخر نشاط'),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='last_platform',
+            field=models.CharField(blank=True, editable=False, max_length=10, verbose_name='آخر منصة'),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='last_token_id',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, verbose_name='آخر جهاز'),
+        ),
+    ]
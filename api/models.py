@@ -2,9 +2,11 @@ from django.db import models, transaction
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 from django.db.models import F
+from django.db.models.functions import Greatest
+from decimal import Decimal
+from functools import partial
 import uuid
-from .apns import send_ios_push_notification, send_android_push_notification
-import asyncio
+from .caching import bump_catalog_version
 
 
 class Section(models.Model):
@@ -12,6 +14,7 @@ class Section(models.Model):
     description = models.TextField(blank=True, null=True, verbose_name="وصف القسم")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="تاريخ الانشاء")
     image = models.ImageField(upload_to='section_images/', verbose_name="صورة القسم الفرعي",null= True , blank= True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False, verbose_name="نسخ الصورة")
 
     def __str__(self):
         return self.name
@@ -26,6 +29,7 @@ class SubSection(models.Model):
     description = models.TextField(blank=True, null=True, verbose_name="وصف القسم الفرعي")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="تاريخ الانشاء")
     image = models.ImageField(upload_to='subsection_images/', verbose_name="صورة القسم الفرعي",null= True , blank= True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False, verbose_name="نسخ الصورة")
 
     def __str__(self):
         return self.name
@@ -40,6 +44,7 @@ class SubSection(models.Model):
 class brand(models.Model):
     brand_name = models.CharField(max_length=255 , verbose_name="اسم البراند",null=True, blank=True)
     brand_image=models.ImageField(upload_to='brandImage/',verbose_name="صورة البراند", null=True,blank=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False, verbose_name="نسخ الصورة")
 
     def __str__(self):
         return self.brand_name 
@@ -52,6 +57,82 @@ class brand(models.Model):
         ]
 
 
+class ProductQuerySet(models.QuerySet):
+    def with_details(self):
+        """
+        Everything ProductSerializer reads, in a constant number of queries.
+        Use it wherever products are serialized (directly or nested).
+        """
+        return self.select_related('brand', 'sub_section').prefetch_related(
+            models.Prefetch('images', queryset=ProductImage.objects.all())
+        )
+
+    def with_effective_price(self):
+        """
+        Annotates `effective_price`, the SQL twin of calculate_discounted_price(),
+        so the price customers pay can be filtered and ordered on in the database.
+        """
+        price = models.DecimalField(max_digits=10, decimal_places=2)
+        zero = models.Value(Decimal('0'), output_field=price)
+        # Multiplying by 0.01 rather than dividing by 100 avoids integer
+        # division on SQLite, where whole-number decimals are stored as ints.
+        percentage_discount = F('price') * F('discount_value') * models.Value(Decimal('0.01'))
+        return self.annotate(
+            effective_price=models.Case(
+                models.When(
+                    discount_type=Product.FIXED,
+                    discount_value__gt=0,
+                    then=Greatest(F('price') - F('discount_value'), zero),
+                ),
+                models.When(
+                    discount_type=Product.PERCENTAGE,
+                    discount_value__gt=0,
+                    then=Greatest(F('price') - percentage_discount, zero),
+                ),
+                default=F('price'),
+                output_field=price,
+            )
+        )
+
+    def reserve_stock(self, quantities):
+        """
+        Takes {product_id: quantity} off stock for every product at once.
+
+        All rows are locked with one SELECT ... FOR UPDATE in primary-key order,
+        so concurrent orders queue up instead of deadlocking, and are then
+        decremented by a single conditional UPDATE. Raises ValidationError
+        listing every product that is missing or short, changing nothing.
+        """
+        quantities = {product_id: quantity for product_id, quantity in quantities.items() if quantity}
+        if not quantities:
+            return
+        with transaction.atomic():
+            stock = dict(
+                self.select_for_update().filter(pk__in=quantities)
+                .order_by('pk').values_list('pk', 'quantity')
+            )
+            short = [product_id for product_id, quantity in quantities.items()
+                     if stock.get(product_id, 0) < quantity]
+            if short:
+                titles = dict(self.filter(pk__in=short).values_list('pk', 'title'))
+                raise ValidationError([
+                    f"لا توجد كمية كافية من {titles.get(product_id, product_id)}." for product_id in short
+                ])
+
+            enough = models.Q()
+            for product_id, quantity in quantities.items():
+                enough |= models.Q(pk=product_id, quantity__gte=quantity)
+            updated = self.filter(enough).update(quantity=models.Case(
+                *[models.When(pk=product_id, then=F('quantity') - quantity)
+                  for product_id, quantity in quantities.items()],
+                output_field=models.PositiveIntegerField(),
+            ))
+            if updated != len(quantities):
+                raise ValidationError("لا يوجد مخزون كاف متاح.")
+            # update() sends no post_save, so expire cached catalog pages here
+            transaction.on_commit(partial(bump_catalog_version, Product))
+
+
 class Product(models.Model):
     FIXED = 'ثابت'
     PERCENTAGE = 'نسبة مئوية'
@@ -65,6 +146,8 @@ class Product(models.Model):
 
     sub_section = models.ForeignKey('SubSection', related_name="products", on_delete=models.CASCADE, verbose_name="اسم اقسم الفرعي")
     title = models.CharField(max_length=255, verbose_name="اسم المنتج")
+    # The supplier's code; catalog imports match existing products on it
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True, verbose_name="رمز المنتج")
     price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="سعر المنتج")
     quantity = models.PositiveIntegerField(verbose_name="الكمية المتوفرة")
     description = models.TextField(blank=True, null=True, verbose_name="وصف المنتج")
@@ -79,9 +162,18 @@ class Product(models.Model):
         verbose_name="هل تريد اظهار المنتج على الصفحة الرئيسية ؟"
     )
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         verbose_name = " المنتجات"
         verbose_name_plural = "المنتجات "
+        # (field, id) pairs back the keyset pagination orderings
+        indexes = [
+            models.Index(fields=['title', 'id']),
+            models.Index(fields=['price', 'id']),
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['sub_section', 'title', 'id']),
+        ]
         constraints = [
             models.CheckConstraint(
                 check=models.Q(
@@ -129,7 +221,7 @@ class Product(models.Model):
             if new_quantity < 0:
                 raise ValidationError("لا يوجد مخزون كاف متاح.")
             product.quantity = new_quantity
-            product.save()
+            product.save(update_fields=['quantity'])
 
     def is_low_stock(self, threshold=5):
         return self.quantity <= threshold
@@ -137,6 +229,7 @@ class Product(models.Model):
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, related_name='images', on_delete=models.CASCADE,verbose_name="المنتج")
     image = models.ImageField(upload_to='product_images/', verbose_name="صورة المنتج")
+    image_variants = models.JSONField(default=dict, blank=True, editable=False, verbose_name="نسخ الصورة")
     created_at = models.DateTimeField(auto_now_add=True,verbose_name="تاريخ الانشاء")
 
     def __str__(self):
@@ -258,8 +351,60 @@ class OrderItem(models.Model):
             models.Index(fields=['product']),  # Index on product for fast item retrieval
         ]
 
+class OrderEvent(models.Model):
+    """
+    Transactional outbox: one row per order and sink, written in the order's
+    transaction and delivered afterwards by api.tasks.drain_order_outbox.
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'بانتظار الارسال'),
+        (SENT, 'تم الارسال'),
+        (FAILED, 'فشل الارسال'),
+    ]
+
+    order = models.ForeignKey(Order, related_name="events", on_delete=models.CASCADE, verbose_name="الطلب")
+    sink = models.CharField(max_length=50, verbose_name="الوجهة")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, verbose_name="الحالة")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="عدد المحاولات")
+    next_attempt_at = models.DateTimeField(default=timezone.now, verbose_name="موعد المحاولة القادمة")
+    last_error = models.TextField(blank=True, verbose_name="آخر خطأ")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="تاريخ الانشاء")
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name="تاريخ الارسال")
+
+    def __str__(self):
+        return f"{self.sink} - طلب {self.order_id}"
+
+    class Meta:
+        verbose_name = "اشعارات الطلبات"
+        verbose_name_plural = "اشعارات الطلبات"
+        indexes = [
+            # The drain only ever reads due pending events
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+
 # Cart Models
 
+class CartQuerySet(models.QuerySet):
+    def with_contents(self):
+        """
+        Loads the coupon, items, products (with brand, sub_section and images)
+        in three queries, so calculate_total() and CartSerializer both run
+        against the same in-memory graph.
+        """
+        return self.select_related('applied_coupon').prefetch_related(
+            models.Prefetch(
+                'items',
+                queryset=CartItem.objects.select_related(
+                    'product__brand', 'product__sub_section'
+                ).prefetch_related('product__images')
+            )
+        )
+
+
 class Cart(models.Model):
     cart_id = models.UUIDField(
         default=uuid.uuid4, unique=True, editable=False,
@@ -271,6 +416,8 @@ class Cart(models.Model):
         verbose_name="الكوبون المطبق اذا كان هنالك"
     )
 
+    objects = CartQuerySet.as_manager()
+
     def calculate_total(self):
         # Sum up each cart item's total price (each should include any product-specific discounts)
         items_total = sum(item.get_total_price() for item in self.items.all())
@@ -282,6 +429,12 @@ class Cart(models.Model):
     def __str__(self):
         return f"السلة {self.cart_id}"
 
+    class Meta:
+        indexes = [
+            # Lets the abandoned-cart reaper walk the oldest carts in order
+            models.Index(fields=['created_at', 'id']),
+        ]
+
 
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, related_name='items', on_delete=models.CASCADE)
@@ -297,12 +450,17 @@ class CartItem(models.Model):
     class Meta:
         verbose_name = "طلبات السلة (هنا يمكنك معرفة المنتجات التي اضافها المستخدم الى سلته لكنه لم يكمل طلبه)"
         verbose_name_plural = "طلبات السلة (هنا يمكنك معرفة المنتجات التي اضافها المستخدم الى سلته لكنه لم يكمل طلبه)"
+        constraints = [
+            # Conflict target for the bulk upsert in AddToCartView
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
 
 
 
 
 class Banner(models.Model):
     image = models.ImageField(upload_to='banner_images/', verbose_name="صورة الشعار")
+    image_variants = models.JSONField(default=dict, blank=True, editable=False, verbose_name="نسخ الصورة")
     section = models.ForeignKey(Section, related_name='banners', on_delete=models.SET_NULL, null=True, blank=True,verbose_name="اسم القسم ")
     subsection = models.ForeignKey(SubSection, related_name='banners', on_delete=models.SET_NULL, null=True, blank=True,verbose_name="اسم القسم الفرعي")
     created_at = models.DateTimeField(auto_now_add=True,verbose_name="تاريخ الانشاء")
@@ -325,52 +483,102 @@ class Banner(models.Model):
 
 
 
+class DeviceTokenQuerySet(models.QuerySet):
+    def upsert(self, registrations):
+        """
+        Inserts or refreshes {token: platform} in one statement, reactivating
+        pruned tokens and stamping last_seen_at.
+        """
+        now = timezone.now()
+        return self.bulk_create(
+            [
+                DeviceToken(token=token, platform=platform, is_active=True, last_seen_at=now)
+                for token, platform in registrations.items()
+            ],
+            update_conflicts=True,
+            unique_fields=['token'],
+            update_fields=['platform', 'is_active', 'last_seen_at'],
+        )
+
+
 class DeviceToken(models.Model):
-    token = models.CharField(max_length=255)
+    token = models.CharField(max_length=255, unique=True)
     platform = models.CharField(
         max_length=10, 
         choices=[('ios', 'iOS'), ('android', 'Android')],
         help_text="Platform of the device (iOS or Android)"
     )
+    is_active = models.BooleanField(default=True, help_text="False once APNs/FCM report the token as dead")
+    last_seen_at = models.DateTimeField(default=timezone.now, help_text="Last time the app registered this token")
+
+    objects = DeviceTokenQuerySet.as_manager()
 
     def __str__(self):
         return f"Token: {self.token}, Platform: {self.platform}"
+
+    class Meta:
+        indexes = [
+            # Broadcasts stream active tokens per platform in id order
+            models.Index(fields=['platform', 'is_active', 'id']),
+        ]
     
 class Alert(models.Model):
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'بانتظار الارسال'),
+        (SENDING, 'جاري الارسال'),
+        (SENT, 'تم الارسال'),
+        (FAILED, 'فشل الارسال'),
+    ]
+
+    # What an edit may change; everything else is broadcast progress
+    CONTENT_FIELDS = ['title', 'message']
+
     title = models.CharField(max_length=255)
     message = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
     is_sent = models.BooleanField(default=False, help_text="هل تم ارسال هذا الاشعار الى المستخدمين؟")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, editable=False, verbose_name="حالة الارسال")
+    total_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="عدد الاجهزة")
+    sent_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="تم الارسال الى")
+    failed_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="فشل الارسال الى")
+    pruned_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="اجهزة تم تعطيلها")
+    started_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="بدأ الارسال")
+    finished_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="انتهى الارسال")
+    # Where a broadcast resumes: the platform it was on and the last token id sent there
+    last_platform = models.CharField(max_length=10, blank=True, editable=False, verbose_name="آخر منصة")
+    last_token_id = models.BigIntegerField(null=True, blank=True, editable=False, verbose_name="آخر جهاز")
+    heartbeat_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="آخر نشاط")
 
     def __str__(self):
         return self.title
 
-    async def send_notification(self):
+    @property
+    def pending_count(self):
+        return max(self.total_count - self.sent_count - self.failed_count, 0)
+
+    def queue_broadcast(self):
         """
-        Sends a notification to all devices registered for this alert.
-        Marks the alert as 'sent' after notification is sent.
+        Hands the alert to a Celery worker once the current transaction commits.
+        The pending row is the durable job: if the broker is down, the periodic
+        dispatch picks it up.
         """
-        # Get all device tokens
-        tokens = DeviceToken.objects.values_list('token', flat=True)
-
-        # Loop through each device token and send the notification
-        for token in tokens:
-            platform = DeviceToken.objects.get(token=token).platform  # Assuming platform is stored in DeviceToken model
-
-            if platform == 'ios':
-                await send_ios_push_notification(token, self.title, self.message)  # Await the async call
-            elif platform == 'android':
-                await send_android_push_notification(token, self.title, self.message)
+        from .tasks import enqueue_alert_broadcast  # tasks imports this module
 
-        # After sending the notification, mark the alert as sent
-        self.is_sent = True
-        self.save()
+        transaction.on_commit(partial(enqueue_alert_broadcast, self.pk))
 
     def save(self, *args, **kwargs):
         """
-        Overriding the save method to send notifications when a new alert is created.
+        Queues new alerts for sending; never sends inline. Saving an existing
+        alert writes only its content: status, counters and cursor belong to
+        the worker and change through update(), so a stale instance can't
+        roll back a broadcast in progress.
         """
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = self.CONTENT_FIELDS
         super().save(*args, **kwargs)
-        if not self.is_sent:  # Only send if it's not already marked as sent
-            # Run the asynchronous method within the event loop
-            asyncio.run(self.send_notification())  # Use asyncio to run the async method
\ No newline at end of file
+        if not self.is_sent and self.status == self.PENDING:
+            self.queue_broadcast()
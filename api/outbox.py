@@ -0,0 +1,131 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import OrderEvent, OrderItem
+from .telegram_utility import get_notifier
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 8
+MAX_RETRY_DELAY = timedelta(hours=1)
+
+
+def telegram_sink(orders):
+    """
+    A sink takes a batch of orders and returns {order_id: error} for the ones
+    it could not deliver.
+    """
+    return get_notifier().send_orders(orders)
+
+
+def get_sinks():
+    return {name: import_string(path) for name, path in settings.ORDER_EVENT_SINKS.items()}
+
+
+def record_order_events(order):
+    """
+    Queues the order for every sink. Call it inside the order's transaction.
+    """
+    OrderEvent.objects.bulk_create([
+        OrderEvent(order=order, sink=sink) for sink in settings.ORDER_EVENT_SINKS
+    ])
+
+
+def retry_delay(attempts):
+    return min(timedelta(seconds=settings.ORDER_EVENT_RETRY_DELAY * 2 ** (attempts - 1)), MAX_RETRY_DELAY)
+
+
+def _deliver(events, sinks):
+    now = timezone.now()
+    by_sink = {}
+    for event in events:
+        by_sink.setdefault(event.sink, []).append(event)
+
+    for name, sink_events in by_sink.items():
+        sink = sinks.get(name)
+        if sink is None:
+            failures = {event.order_id: f"Unknown sink {name!r}" for event in sink_events}
+        else:
+            try:
+                failures = sink([event.order for event in sink_events])
+            except Exception as e:
+                logger.exception("Order event sink %s failed", name)
+                failures = {event.order_id: str(e) for event in sink_events}
+
+        for event in sink_events:
+            error = failures.get(event.order_id)
+            if error is None:
+                event.status = OrderEvent.SENT
+                event.sent_at = now
+                continue
+            event.attempts += 1
+            event.last_error = error
+            if event.attempts >= MAX_ATTEMPTS:
+                event.status = OrderEvent.FAILED
+            else:
+                event.next_attempt_at = now + retry_delay(event.attempts)
+
+
+def _claim(batch_size):
+    """
+    Leases up to `batch_size` due events by pushing next_attempt_at past the
+    claim timeout, in a transaction that commits straight away. Returns the
+    ids and the lease, which identifies this claim when results are written.
+    """
+    lease = timezone.now() + timedelta(seconds=settings.ORDER_EVENT_CLAIM_TIMEOUT)
+    with transaction.atomic():
+        event_ids = list(
+            OrderEvent.objects.select_for_update(skip_locked=True)
+            .filter(status=OrderEvent.PENDING, next_attempt_at__lte=timezone.now())
+            .order_by('next_attempt_at', 'id')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        OrderEvent.objects.filter(pk__in=event_ids).update(next_attempt_at=lease)
+    return event_ids, lease
+
+
+def drain_outbox(batch_size=50, max_batches=20):
+    """
+    Delivers due pending events, oldest first, one claimed batch at a time.
+
+    Each batch is claimed in a short transaction, sent with no transaction
+    open (sinks may sleep on rate limits), and its results written in a
+    second short one. A drain that dies mid-batch leaves the events pending;
+    they are due again once the claim times out. Returns the number of
+    events handled.
+    """
+    sinks = get_sinks()
+    handled = 0
+    for _ in range(max_batches):
+        event_ids, lease = _claim(batch_size)
+        if not event_ids:
+            break
+        events = list(
+            OrderEvent.objects.filter(pk__in=event_ids)
+            .select_related('order__customer', 'order__coupon')
+            .prefetch_related(models.Prefetch(
+                'order__items', queryset=OrderItem.objects.select_related('product')
+            ))
+            .order_by('id')
+        )
+        _deliver(events, sinks)
+        with transaction.atomic():
+            # A claim that outlived its timeout may have been taken over
+            still_ours = set(
+                OrderEvent.objects.select_for_update()
+                .filter(pk__in=event_ids, next_attempt_at=lease)
+                .values_list('id', flat=True)
+            )
+            OrderEvent.objects.bulk_update(
+                [event for event in events if event.pk in still_ours],
+                ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'],
+            )
+        handled += len(events)
+        if len(event_ids) < batch_size:
+            break
+    return handled
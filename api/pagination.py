@@ -0,0 +1,128 @@
+import base64
+import json
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Forward-only keyset pagination over (<field>, id).
+
+    Each page is a range scan on a composite (<field>, id) index that starts
+    right after the last row of the previous page, so there is no OFFSET and
+    no COUNT(*) no matter how deep the client scrolls.
+    """
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    default_ordering = 'title'
+
+    # field -> parser for the value stored in the cursor. effective_price is
+    # an annotation (see Product.objects.with_effective_price()) and has no index.
+    orderings = {
+        'title': str,
+        'price': Decimal,
+        'created_at': parse_datetime,
+        'effective_price': Decimal,
+    }
+    invalid_cursor_message = 'المؤشر غير صالح'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.field, self.descending = self.get_ordering(request)
+        page_size = self.get_page_size(request)
+
+        prefix = '-' if self.descending else ''
+        queryset = queryset.order_by(f'{prefix}{self.field}', f'{prefix}id')
+
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.get_keyset_filter(*position))
+
+        # One extra row tells us whether there is a next page
+        results = list(queryset[:page_size + 1])
+        self.has_next = len(results) > page_size
+        results = results[:page_size]
+        self.last = results[-1] if results else None
+        return results
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_ordering(self, request):
+        ordering = request.query_params.get(self.ordering_query_param, self.default_ordering)
+        field = ordering.lstrip('-')
+        if field not in self.orderings:
+            return self.default_ordering, False
+        return field, ordering.startswith('-')
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def get_keyset_filter(self, value, pk):
+        """
+        (field, id) > (value, pk), spelled so the leading range condition can
+        seek on the composite index on every backend.
+        """
+        if self.descending:
+            return Q(**{f'{self.field}__lte': value}) & (Q(**{f'{self.field}__lt': value}) | Q(id__lt=pk))
+        return Q(**{f'{self.field}__gte': value}) & (Q(**{f'{self.field}__gt': value}) | Q(id__gt=pk))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            if payload['o'] != self.field:
+                raise ValueError
+            value = self.orderings[self.field](payload['v'])
+            if value is None:
+                raise ValueError
+            return value, int(payload['id'])
+        except (KeyError, TypeError, ValueError, InvalidOperation):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, obj):
+        value = getattr(obj, self.field)
+        payload = {
+            'o': self.field,
+            'v': value.isoformat() if hasattr(value, 'isoformat') else str(value),
+            'id': obj.pk,
+        }
+        return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.last))
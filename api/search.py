@@ -0,0 +1,217 @@
+import re
+
+from django.db import connection as default_connection
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+
+# Harakat, Quranic marks and superscript alef
+ARABIC_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed]')
+TATWEEL = '\u0640'
+ARABIC_LETTERS = str.maketrans({
+    'أ': 'ا',
+    'إ': 'ا',
+    'آ': 'ا',
+    'ٱ': 'ا',
+    'ى': 'ي',
+    'ة': 'ه',
+})
+TOKEN = re.compile(r'\w+')
+
+
+def normalize_arabic(text):
+    """
+    Folds the spelling variants people type interchangeably: strips tashkeel
+    and tatweel and unifies alef, ya and ta marbuta forms.
+    """
+    if not text:
+        return ''
+    text = ARABIC_DIACRITICS.sub('', text).replace(TATWEEL, '')
+    return text.translate(ARABIC_LETTERS).lower()
+
+
+def tokenize(text):
+    return TOKEN.findall(normalize_arabic(text))
+
+
+def _documents(products):
+    """
+    Yields (id, title, description, brand_name, sub_section_name), normalized.
+    Works on historical models too, so migrations can build the index.
+    """
+    rows = products.values_list(
+        'id', 'title', 'description', 'brand__brand_name', 'sub_section__name'
+    ).order_by('id')
+    for product_id, *fields in rows.iterator(chunk_size=2000):
+        yield (product_id, *(normalize_arabic(field) for field in fields))
+
+
+class BaseSearchBackend:
+    def __init__(self, connection=None):
+        self.connection = connection or default_connection
+
+    def create(self):
+        raise NotImplementedError
+
+    def drop(self):
+        raise NotImplementedError
+
+    def index(self, products):
+        """
+        (Re)indexes every product in the queryset.
+        """
+        raise NotImplementedError
+
+    def remove(self, product_ids):
+        raise NotImplementedError
+
+    def filter_queryset(self, queryset, query):
+        """
+        Restricts the product queryset to matches of every query token and
+        adds a `search_rank` column, higher for better matches. The index is
+        queried in subqueries, so ordering by rank and paginating stay in the
+        database however many products match. Returns None when the query
+        has no tokens.
+        """
+        raise NotImplementedError
+
+    def rebuild(self, products, batch_size=2000):
+        self.drop()
+        self.create()
+        product_ids = list(products.order_by('id').values_list('id', flat=True))
+        for start in range(0, len(product_ids), batch_size):
+            self.index(products.filter(id__in=product_ids[start:start + batch_size]))
+        return len(product_ids)
+
+
+class SQLiteSearchBackend(BaseSearchBackend):
+    """
+    FTS5 virtual table whose rowid is the product id.
+    """
+    table = 'api_product_fts'
+    # bm25 weights for title, description, brand_name, sub_section_name
+    weights = (10.0, 1.0, 4.0, 2.0)
+
+    def create(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5("
+                "title, description, brand_name, sub_section_name, "
+                "tokenize = 'unicode61 remove_diacritics 2')"
+            )
+
+    def drop(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {self.table}")
+
+    def remove(self, product_ids):
+        product_ids = list(product_ids)
+        if not product_ids:
+            return
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid IN ({placeholders})", product_ids)
+
+    def index(self, products):
+        documents = list(_documents(products))
+        self.remove(document[0] for document in documents)
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.table} (rowid, title, description, brand_name, sub_section_name) "
+                "VALUES (%s, %s, %s, %s, %s)",
+                documents
+            )
+
+    def filter_queryset(self, queryset, query):
+        tokens = tokenize(query)
+        if not tokens:
+            return None
+        # Every token must match, each as a prefix so partial words still hit
+        match = ' '.join('"%s"*' % token.replace('"', '""') for token in tokens)
+        weights = ', '.join(str(weight) for weight in self.weights)
+        products = queryset.model._meta.db_table
+        matching = RawSQL(f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s", [match])
+        # bm25 is lower for better matches
+        rank = RawSQL(
+            f"SELECT -bm25({self.table}, {weights}) FROM {self.table} "
+            f"WHERE {self.table} MATCH %s AND rowid = {products}.id",
+            [match], output_field=FloatField(),
+        )
+        return queryset.filter(pk__in=matching).annotate(search_rank=rank)
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    Side table holding a weighted tsvector per product, behind a GIN index.
+    """
+    table = 'api_product_search'
+    document_sql = (
+        "setweight(to_tsvector('simple', %s), 'A') || "
+        "setweight(to_tsvector('simple', %s), 'C') || "
+        "setweight(to_tsvector('simple', %s), 'B') || "
+        "setweight(to_tsvector('simple', %s), 'B')"
+    )
+
+    def create(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "product_id bigint PRIMARY KEY REFERENCES api_product (id) "
+                "ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+                "document tsvector NOT NULL)"
+            )
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_document_idx "
+                f"ON {self.table} USING GIN (document)"
+            )
+
+    def drop(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {self.table}")
+
+    def remove(self, product_ids):
+        product_ids = list(product_ids)
+        if not product_ids:
+            return
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE product_id = ANY(%s)", [product_ids])
+
+    def index(self, products):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.table} (product_id, document) VALUES (%s, {self.document_sql}) "
+                "ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document",
+                list(_documents(products))
+            )
+
+    def filter_queryset(self, queryset, query):
+        tokens = tokenize(query)
+        if not tokens:
+            return None
+        # \w+ tokens can't carry tsquery operators, so this is safe to build
+        tsquery = ' & '.join(f'{token}:*' for token in tokens)
+        products = queryset.model._meta.db_table
+        matching = RawSQL(
+            f"SELECT product_id FROM {self.table} WHERE document @@ to_tsquery('simple', %s)", [tsquery]
+        )
+        rank = RawSQL(
+            f"SELECT ts_rank(document, to_tsquery('simple', %s)) FROM {self.table} "
+            f"WHERE product_id = {products}.id",
+            [tsquery], output_field=FloatField(),
+        )
+        return queryset.filter(pk__in=matching).annotate(search_rank=rank)
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_search_backend(connection=None):
+    """
+    The index backend for the given (default) database, or None when there
+    isn't one; callers then fall back to icontains lookups.
+    """
+    connection = connection or default_connection
+    backend = BACKENDS.get(connection.vendor)
+    return backend(connection) if backend else None
@@ -1,17 +1,49 @@
 from rest_framework import serializers
 from .models import Section, SubSection, Product, ProductImage, Coupon, brand, OrderItem, Order, Cart, CartItem,Banner,DeviceToken
+from .images import variant_urls
 
 
+class SrcsetField(serializers.ReadOnlyField):
+    """
+    The image's resized copies as {format: {width: url}}, empty until they
+    have been generated.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('source', 'image_variants')
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return variant_urls(value, self.context.get('request'))
+
+
+class PlaceholderField(serializers.ReadOnlyField):
+    """
+    {'color': '#rrggbb', 'lqip': data URI} to paint while the image loads,
+    or None until it has been computed.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('source', 'image_variants')
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return (value or {}).get('placeholder')
+
 
 class SectionSerializer(serializers.ModelSerializer):
+    srcset = SrcsetField()
+
     class Meta:
         model = Section
-        fields = ['id', 'name', 'image', 'created_at']
+        fields = ['id', 'name', 'image', 'srcset', 'created_at']
 
 class SubSectionSerializer(serializers.ModelSerializer):
+    srcset = SrcsetField()
+
     class Meta:
         model = SubSection
-        fields = ['id', 'name', 'image', 'created_at']
+        fields = ['id', 'name', 'image', 'srcset', 'created_at']
 
 class SectionWithSubsectionsSerializer(SectionSerializer):
     sub_sections = SubSectionSerializer(many=True, read_only=True)
@@ -21,17 +53,22 @@ class SectionWithSubsectionsSerializer(SectionSerializer):
 
 
 class BrandListSerializer(serializers.ModelSerializer):
+    srcset = SrcsetField()
+
     class Meta:
         model = brand
-        fields = '__all__'
+        fields = ['id', 'brand_name', 'brand_image', 'srcset']
 
 
 
 
 class ProductImageSerializer(serializers.ModelSerializer):
+    srcset = SrcsetField()
+    placeholder = PlaceholderField()
+
     class Meta:
         model = ProductImage
-        fields = ['id', 'image', 'created_at']
+        fields = ['id', 'image', 'srcset', 'placeholder', 'created_at']
 
 
 
@@ -51,6 +88,9 @@ class ProductSerializer(serializers.ModelSerializer):
         ]
 
     def get_discounted_price(self, obj):
+        # Prefer the database-computed annotation when the queryset has it
+        if hasattr(obj, 'effective_price'):
+            return obj.effective_price
         return obj.calculate_discounted_price()
 
 
@@ -135,12 +175,14 @@ class OrderSerializer(serializers.ModelSerializer):
 
 
 class BannerSerializer(serializers.ModelSerializer):
+    srcset = SrcsetField()
+    placeholder = PlaceholderField()
     target_type = serializers.SerializerMethodField()
     target_id = serializers.SerializerMethodField()
 
     class Meta:
         model = Banner
-        fields = ['id', 'image', 'target_type', 'target_id', 'created_at']
+        fields = ['id', 'image', 'srcset', 'placeholder', 'target_type', 'target_id', 'created_at']
         read_only_fields = ['created_at']
 
     def get_target_type(self, obj):
@@ -166,12 +208,15 @@ class BannerSerializer(serializers.ModelSerializer):
 class DeviceTokenSerializer(serializers.ModelSerializer):
     class Meta:
         model = DeviceToken
-        fields = '__all__'
+        fields = ['token', 'platform']
+        # Registering a known token again is an upsert, not an error
+        extra_kwargs = {'token': {'validators': []}}
 
 
 class BrandDetailSerializer(serializers.ModelSerializer):
     products = ProductSerializer(many=True, read_only=True, source='brand')  
-    
+    srcset = SrcsetField()
+
     class Meta:
         model = brand
-        fields = '__all__'
\ No newline at end of file
+        fields = ['id', 'brand_name', 'brand_image', 'srcset', 'products']
\ No newline at end of file
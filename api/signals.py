@@ -0,0 +1,130 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+
+from .caching import bump_catalog_version, bump_suggestion_version
+from .images import IMAGE_FIELDS, needs_variants
+from .search import get_search_backend
+from .suggest import suggestion_index
+from .tasks import enqueue_image_variants
+from .models import Banner, Coupon, Product, ProductImage, Section, SubSection, brand
+
+# Coupon edits change cart totals, so carts version on it as well
+VERSIONED_MODELS = (Product, ProductImage, SubSection, Section, brand, Banner, Coupon)
+
+
+def catalog_changed(sender, **kwargs):
+    """
+    Invalidates cached responses once the change is committed, so a
+    concurrent reader can't re-cache the old rows under the new version.
+    """
+    transaction.on_commit(partial(bump_catalog_version, sender))
+
+
+# Connected per model rather than globally so unrelated models keep Django's
+# fast-delete path (a sender-less receiver disables it everywhere).
+for model in VERSIONED_MODELS:
+    post_save.connect(catalog_changed, sender=model, dispatch_uid=f"catalog_save_{model.__name__}")
+    post_delete.connect(catalog_changed, sender=model, dispatch_uid=f"catalog_delete_{model.__name__}")
+
+
+# Fields copied into the search index, per model, and how products reach them
+SEARCH_FIELDS = {
+    Product: ({'title', 'description', 'brand', 'sub_section'}, 'pk'),
+    brand: ({'brand_name'}, 'brand'),
+    SubSection: ({'name'}, 'sub_section'),
+}
+
+
+def search_source_saved(sender, instance, update_fields=None, **kwargs):
+    fields, lookup = SEARCH_FIELDS[sender]
+    if update_fields and not fields.intersection(update_fields):
+        return
+    backend = get_search_backend()
+    if backend is not None:
+        backend.index(Product.objects.filter(**{lookup: instance.pk}))
+
+
+def product_deleted(sender, instance, **kwargs):
+    backend = get_search_backend()
+    if backend is not None:
+        backend.remove([instance.pk])
+
+
+def brand_deleting(sender, instance, **kwargs):
+    # The FK is nulled before post_delete, so remember who pointed here
+    instance._search_product_ids = list(instance.brand.values_list('pk', flat=True))
+
+
+def brand_deleted(sender, instance, **kwargs):
+    backend = get_search_backend()
+    product_ids = getattr(instance, '_search_product_ids', None)
+    if backend is not None and product_ids:
+        backend.index(Product.objects.filter(pk__in=product_ids))
+
+
+for model in SEARCH_FIELDS:
+    post_save.connect(search_source_saved, sender=model, dispatch_uid=f"search_save_{model.__name__}")
+post_delete.connect(product_deleted, sender=Product, dispatch_uid="search_delete_Product")
+pre_delete.connect(brand_deleting, sender=brand, dispatch_uid="search_predelete_brand")
+post_delete.connect(brand_deleted, sender=brand, dispatch_uid="search_delete_brand")
+
+
+# What suggestions are built from; saves that change none of it leave the
+# index and its version alone
+SUGGESTION_FIELDS = {
+    Product: ('title', 'brand'),
+    brand: ('brand_name',),
+}
+
+
+def suggestion_source_saving(sender, instance, update_fields=None, **kwargs):
+    fields = SUGGESTION_FIELDS[sender]
+    if update_fields is not None and not set(fields).intersection(update_fields):
+        changed = False
+    elif instance.pk is None or instance._state.adding:
+        changed = True
+    else:
+        attnames = [sender._meta.get_field(field).attname for field in fields]
+        stored = sender.objects.filter(pk=instance.pk).values_list(*attnames).first()
+        changed = stored != tuple(getattr(instance, attname) for attname in attnames)
+    instance._suggestion_changed = changed
+
+
+def _apply_suggestion_change(product_ids):
+    suggestion_index.refresh_products(product_ids, bump_suggestion_version())
+
+
+def suggestions_changed(sender, instance, **kwargs):
+    if sender is Product:
+        product_ids = [instance.pk]
+    elif hasattr(instance, '_search_product_ids'):
+        product_ids = instance._search_product_ids
+    else:
+        product_ids = list(instance.brand.values_list('pk', flat=True))
+    # After commit, so other processes rebuild from the committed rows
+    transaction.on_commit(partial(_apply_suggestion_change, product_ids))
+
+
+def suggestion_source_saved(sender, instance, **kwargs):
+    if instance._suggestion_changed:
+        suggestions_changed(sender, instance)
+
+
+for model in SUGGESTION_FIELDS:
+    pre_save.connect(suggestion_source_saving, sender=model, dispatch_uid=f"suggest_presave_{model.__name__}")
+    post_save.connect(suggestion_source_saved, sender=model, dispatch_uid=f"suggest_save_{model.__name__}")
+    post_delete.connect(suggestions_changed, sender=model, dispatch_uid=f"suggest_delete_{model.__name__}")
+
+
+def image_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields and IMAGE_FIELDS[sender] not in update_fields:
+        return
+    if needs_variants(instance):
+        # Pillow work runs on a Celery worker, never on the request thread
+        transaction.on_commit(partial(enqueue_image_variants, sender, instance.pk))
+
+
+for model in IMAGE_FIELDS:
+    post_save.connect(image_saved, sender=model, dispatch_uid=f"images_save_{model.__name__}")
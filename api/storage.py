@@ -0,0 +1,47 @@
+import hashlib
+import os
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+HASH_LENGTH = 20
+
+# A hex digest as the file's stem or as its last dot-separated part before
+# the extension: <hash>.png from this storage, x-160w.<hash>.webp from
+# variants built before they were saved through it
+HASHED_NAME = re.compile(r'(^|[/.])[0-9a-f]{12,}\.[A-Za-z0-9]+$')
+
+
+def is_hashed_name(name):
+    """
+    Whether the name is derived from the file's content, so whatever it
+    points at never changes and can be cached forever.
+    """
+    return bool(HASHED_NAME.search(name))
+
+
+class HashedFileSystemStorage(FileSystemStorage):
+    """
+    Saves every file as <upload dir>/<sha256 prefix><ext>. Identical uploads
+    share one file, and a name, once written, never points at other bytes.
+    """
+
+    def hashed_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        return os.path.join(directory, digest.hexdigest()[:HASH_LENGTH] + extension)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.hashed_name(self.generate_filename(name), content)
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length=max_length)
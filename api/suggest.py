@@ -0,0 +1,159 @@
+import bisect
+import logging
+import threading
+
+from django.db import DatabaseError, connection
+
+from .caching import get_suggestion_version
+from .models import Product
+from .search import normalize_arabic, tokenize
+
+logger = logging.getLogger(__name__)
+
+# Lower ranks first: whole-title prefix, then a title word, then the brand
+TITLE, TITLE_WORD, BRAND = 0, 1, 2
+RANKS = (TITLE, TITLE_WORD, BRAND)
+
+
+class SuggestionIndex:
+    """
+    In-memory prefix index over normalized product titles and brand names.
+
+    Each rank has its own sorted list of (key, product_id) entries, so a
+    prefix lookup is a bisect plus a forward scan per rank, best rank first,
+    that stops as soon as `limit` products are found. The index is patched
+    in place for changes made by this process. When the suggestion version
+    shows a change it hasn't applied (only title, brand and product
+    create/delete changes bump it), a background thread rebuilds it while
+    requests keep answering from the current snapshot.
+    """
+    # Tests turn this off to rebuild on the calling thread
+    background_refresh = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Held for a whole rebuild, so one runs at a time
+        self._build_lock = threading.Lock()
+        # (one sorted entry list per rank, product_id -> (title, brand_name)), swapped as one
+        self._snapshot = (tuple([] for _ in RANKS), {})
+        self._version = None
+
+    @staticmethod
+    def _entries_for(product_id, title, brand_name):
+        """
+        {(rank, (key, product_id))} for one product.
+        """
+        entries = {(TITLE, (normalize_arabic(title), product_id))}
+        entries.update((TITLE_WORD, (word, product_id)) for word in tokenize(title))
+        if brand_name:
+            entries.add((BRAND, (normalize_arabic(brand_name), product_id)))
+            entries.update((BRAND, (word, product_id)) for word in tokenize(brand_name))
+        return entries
+
+    def build(self):
+        with self._build_lock:
+            self._build()
+
+    def _build(self):
+        # Read before the rows, so a change landing mid-scan leaves us behind
+        version = get_suggestion_version()
+        entries = tuple([] for _ in RANKS)
+        products = {}
+        rows = Product.objects.values_list('id', 'title', 'brand__brand_name')
+        for product_id, title, brand_name in rows.iterator(chunk_size=5000):
+            products[product_id] = (title, brand_name)
+            for rank, entry in self._entries_for(product_id, title, brand_name):
+                entries[rank].append(entry)
+        for ranked in entries:
+            ranked.sort()
+        with self._lock:
+            self._snapshot, self._version = (entries, products), version
+
+    def _background_build(self):
+        try:
+            self._build()
+        except DatabaseError:
+            logger.warning("Could not refresh the suggestion index", exc_info=True)
+        finally:
+            self._build_lock.release()
+            # This thread's connection would otherwise stay open
+            connection.close()
+
+    def _ensure_fresh(self):
+        if self._version is None:
+            # Nothing to answer from yet: build once, the others wait for it
+            with self._build_lock:
+                if self._version is None:
+                    self._build()
+            return
+        if self._version == get_suggestion_version():
+            return
+        # Already rebuilding: keep answering from the current snapshot
+        if not self._build_lock.acquire(blocking=False):
+            return
+        if self.background_refresh:
+            threading.Thread(target=self._background_build, name="suggestion-index", daemon=True).start()
+            return
+        try:
+            self._build()
+        finally:
+            self._build_lock.release()
+
+    def refresh_products(self, product_ids, version=None):
+        """
+        Re-reads the given products (dropping deleted ones) without a full
+        rebuild. `version` is the suggestion version the change bumped to;
+        it is recorded only if the index was current just before it, so a
+        change from another process still triggers a rebuild.
+        """
+        product_ids = set(product_ids)
+        rows = Product.objects.filter(pk__in=product_ids).values_list('id', 'title', 'brand__brand_name')
+        with self._lock:
+            if self._version is None:
+                return
+            # Copy-on-write: readers keep using the previous lists meanwhile
+            entries = tuple(list(ranked) for ranked in self._snapshot[0])
+            products = dict(self._snapshot[1])
+            for product_id in product_ids:
+                old = products.pop(product_id, None)
+                if old is not None:
+                    for rank, entry in self._entries_for(product_id, *old):
+                        index = bisect.bisect_left(entries[rank], entry)
+                        if index < len(entries[rank]) and entries[rank][index] == entry:
+                            del entries[rank][index]
+            for product_id, title, brand_name in rows:
+                products[product_id] = (title, brand_name)
+                for rank, entry in self._entries_for(product_id, title, brand_name):
+                    bisect.insort(entries[rank], entry)
+            self._snapshot = (entries, products)
+            if version is not None and self._version == version - 1:
+                self._version = version
+
+    def suggest(self, query, limit=10):
+        prefix = normalize_arabic(query).strip()
+        if not prefix:
+            return []
+        self._ensure_fresh()
+
+        entries, products = self._snapshot
+        found = []
+        seen = set()
+        # Every match of a better rank comes before any of a worse one, so
+        # the scan can stop at `limit` products however short the prefix
+        for ranked in entries:
+            index = bisect.bisect_left(ranked, (prefix,))
+            while len(found) < limit and index < len(ranked):
+                key, product_id = ranked[index]
+                if not key.startswith(prefix):
+                    break
+                if product_id not in seen:
+                    seen.add(product_id)
+                    found.append(product_id)
+                index += 1
+        return [
+            {'id': product_id, 'title': products[product_id][0], 'brand_name': products[product_id][1]}
+            for product_id in found
+        ]
+
+
+suggestion_index = SuggestionIndex()
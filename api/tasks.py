@@ -0,0 +1,102 @@
+import logging
+
+from datetime import timedelta
+
+from celery import shared_task
+from django.apps import apps
+from django.db.models import Q
+from django.utils import timezone
+
+from .broadcast import broadcast_alert, stalled_alerts
+from .cart_store import reap_abandoned_carts as reap_carts
+from .images import generate_image_variants
+from .models import Alert
+from .outbox import drain_outbox
+from .utility import deliver_otp, otp_failed
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def reap_abandoned_carts():
+    return reap_carts()
+
+
+@shared_task
+def drain_order_outbox():
+    return drain_outbox()
+
+
+def schedule_outbox_drain():
+    """
+    Starts a drain right away. If the broker is unreachable the events stay
+    pending and the periodic drain picks them up.
+    """
+    try:
+        drain_order_outbox.delay()
+    except Exception:
+        logger.warning("Could not queue an order outbox drain", exc_info=True)
+
+
+@shared_task
+def send_alert(alert_id):
+    return broadcast_alert(alert_id)
+
+
+def enqueue_alert_broadcast(alert_id):
+    try:
+        send_alert.delay(alert_id)
+    except Exception:
+        logger.warning("Could not queue alert %s; the periodic dispatch will retry", alert_id, exc_info=True)
+
+
+@shared_task
+def dispatch_pending_alerts():
+    """
+    Re-queues alerts still pending a while after they were saved, e.g. because
+    the broker was unreachable at the time, and broadcasts whose worker died;
+    those resume from their cursor.
+    """
+    stale = timezone.now() - timedelta(minutes=2)
+    alert_ids = list(
+        Alert.objects.filter(Q(status=Alert.PENDING, created_at__lt=stale) | stalled_alerts())
+        .values_list('pk', flat=True)
+    )
+    for alert_id in alert_ids:
+        enqueue_alert_broadcast(alert_id)
+    return len(alert_ids)
+
+
+@shared_task
+def send_otp(phone_number, otp, request_id):
+    return deliver_otp(phone_number, otp, request_id)
+
+
+def enqueue_otp(phone_number, otp, request_id):
+    """
+    Hands the OTP to a worker. Nothing retries it if the broker is
+    unreachable, so the request is marked failed and the customer can resend.
+    """
+    try:
+        send_otp.delay(phone_number, otp, request_id)
+    except Exception:
+        logger.warning("Could not queue OTP request %s", request_id, exc_info=True)
+        otp_failed(phone_number, request_id)
+
+
+@shared_task
+def build_image_variants(model_label, pk):
+    variants = generate_image_variants(apps.get_model(model_label), pk)
+    return variants is not None
+
+
+def enqueue_image_variants(model, pk):
+    """
+    Hands the resize work to a worker so uploads return straight away. Rows
+    missed while the broker is down are picked up by the
+    rebuild_image_derivatives command, which skips up-to-date rows.
+    """
+    try:
+        build_image_variants.delay(model._meta.label, pk)
+    except Exception:
+        logger.warning("Could not queue image variants for %s %s", model._meta.label, pk, exc_info=True)
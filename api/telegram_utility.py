@@ -1,11 +1,30 @@
+import logging
+import threading
+import time
+
 import requests
 from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
 
-def send_order_to_telegram(customer, order):
-    bot_token = settings.TELEGRAM_BOT_TOKEN
-    chat_id = settings.TELEGRAM_CHAT_ID
-    
-    # Build the message text
+logger = logging.getLogger(__name__)
+
+# Telegram rejects longer messages
+MAX_MESSAGE_LENGTH = 4096
+DIGEST_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+# How long the sent parts of a long order are remembered for its retries
+SENT_PARTS_TIMEOUT = 60 * 60 * 24
+
+
+def _sent_parts_key(order_id):
+    return f"telegram:order-parts:{order_id}"
+
+
+def format_order(customer, order):
+    """
+    The message text for one order. Reads order.items (with their products)
+    and the coupon, so pass an order with those already fetched.
+    """
     lines = []
     lines.append("📦 *يوجد لدينا طلب جديد*")
     lines.append(f"👤 *اسم المستخدم:* {customer.username or 'Unknown'}")
@@ -25,15 +44,190 @@ def send_order_to_telegram(customer, order):
     lines.append("")
     lines.append(f"💰 *السعر الكلي:* الف{total_price:.2f}")
 
-    message_text = "\n".join(lines)
+    return "\n".join(lines)
+
+
+def _split(text):
+    """
+    Cuts a text longer than one message on line boundaries.
+    """
+    chunks, current = [], ""
+    for line in text.split("\n"):
+        while len(line) > MAX_MESSAGE_LENGTH:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:MAX_MESSAGE_LENGTH])
+            line = line[MAX_MESSAGE_LENGTH:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > MAX_MESSAGE_LENGTH:
+            chunks.append(current)
+            candidate = line
+        current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def build_digests(entries):
+    """
+    Packs (key, text) entries into as few messages as fit, in order.
+    Returns [(text, [keys])]; a key can span several messages when its text
+    alone is too long.
+    """
+    digests = []
+    text, keys = "", []
+    for key, entry in entries:
+        if len(entry) > MAX_MESSAGE_LENGTH:
+            if keys:
+                digests.append((text, keys))
+                text, keys = "", []
+            digests.extend((chunk, [key]) for chunk in _split(entry))
+            continue
+        candidate = f"{text}{DIGEST_SEPARATOR}{entry}" if keys else entry
+        if len(candidate) > MAX_MESSAGE_LENGTH:
+            digests.append((text, keys))
+            candidate, keys = entry, []
+        text = candidate
+        keys.append(key)
+    if keys:
+        digests.append((text, keys))
+    return digests
+
+
+class TokenBucket:
+    """
+    Allows `rate` acquisitions per second on average, with bursts of up to
+    `capacity`; acquire() blocks until a token is free.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.updated = time.monotonic()
+                self.tokens = 1
+            self.tokens -= 1
 
-    # Telegram supports Markdown, enable it if you like
-    payload = {
-        'chat_id': chat_id,
-        'text': message_text,
-        'parse_mode': 'Markdown'
-    }
 
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    response = requests.post(url, data=payload)
-    response.raise_for_status()  # Will raise an error if request failed
+class TelegramNotifier:
+    """
+    Sends order notifications to one chat over a pooled keep-alive session.
+
+    Messages are paced by a token bucket sized for Telegram's per-chat limit,
+    several orders are coalesced into one digest message when they arrive
+    together, and a 429 is waited out using the retry_after Telegram sends.
+    The bucket is per process; the retry_after handling covers the rest.
+    """
+    max_retries = 3
+
+    def __init__(self, bot_token, chat_id, messages_per_minute=20, burst=3, timeout=10):
+        self.url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+        self.chat_id = chat_id
+        self.timeout = timeout
+        self.bucket = TokenBucket(messages_per_minute / 60, burst)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+    def send_message(self, text):
+        payload = {
+            'chat_id': self.chat_id,
+            'text': text,
+            'parse_mode': 'Markdown'
+        }
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            response = self.session.post(self.url, data=payload, timeout=self.timeout)
+            if response.status_code != 429 or attempt == self.max_retries:
+                break
+            try:
+                retry_after = response.json()['parameters']['retry_after']
+            except (ValueError, KeyError, TypeError):
+                retry_after = 1
+            logger.warning("Telegram rate limit hit, retrying in %ss", retry_after)
+            time.sleep(retry_after)
+        response.raise_for_status()
+
+    def _send_order_message(self, order_id, text, failures):
+        try:
+            self.send_message(text)
+        except requests.RequestException as e:
+            failures[order_id] = str(e)
+            return False
+        return True
+
+    def send_orders(self, orders):
+        """
+        Announces the orders in as few messages as possible. Returns
+        {order_id: error} for orders whose message could not be sent.
+
+        A digest that fails is resent one order per message, so only the
+        orders that really can't be sent are reported. An order too long for
+        one message is sent in parts; the parts already sent are remembered,
+        so a later retry sends only the rest.
+        """
+        failures = {}
+        texts = {order.pk: format_order(order.customer, order) for order in orders}
+        # order_id -> (index of the current part, indexes already sent)
+        parts = {}
+        for text, order_ids in build_digests(texts.items()):
+            if len(order_ids) > 1:
+                try:
+                    self.send_message(text)
+                except requests.RequestException:
+                    logger.warning("Telegram digest of orders %s failed, sending them one by one", order_ids, exc_info=True)
+                    for order_id in order_ids:
+                        self._send_order_message(order_id, texts[order_id], failures)
+                continue
+
+            order_id = order_ids[0]
+            if len(texts[order_id]) <= MAX_MESSAGE_LENGTH:
+                self._send_order_message(order_id, text, failures)
+                continue
+            index, sent = parts.get(order_id) or (-1, cache.get(_sent_parts_key(order_id), set()))
+            index += 1
+            parts[order_id] = (index, sent)
+            # After a failed part the rest wait for the retry, which starts there
+            if order_id in failures or index in sent:
+                continue
+            if self._send_order_message(order_id, text, failures):
+                sent.add(index)
+                cache.set(_sent_parts_key(order_id), sent, SENT_PARTS_TIMEOUT)
+
+        cache.delete_many([_sent_parts_key(order_id) for order_id in parts if order_id not in failures])
+        return failures
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def get_notifier():
+    """
+    The process-wide notifier, so every send shares one connection pool and
+    one rate limit.
+    """
+    global _notifier
+    if _notifier is None:
+        with _notifier_lock:
+            if _notifier is None:
+                _notifier = TelegramNotifier(
+                    settings.TELEGRAM_BOT_TOKEN,
+                    settings.TELEGRAM_CHAT_ID,
+                    messages_per_minute=settings.TELEGRAM_MESSAGES_PER_MINUTE,
+                )
+    return _notifier
+
+
+def send_order_to_telegram(customer, order):
+    get_notifier().send_message(format_order(customer, order))
@@ -1,3 +1,1000 @@
-from django.test import TestCase
+import base64
+import csv
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from firebase_admin import messaging
+from PIL import Image
+
+from .broadcast import APNsSender, broadcast_alert
+from .caching import bump_suggestion_version, get_suggestion_version
+from .cart_store import CacheCartStore, CartLocked
+from .catalog_io import CatalogImporter
+from .images import generate_image_variants
+from .models import Banner, Section, SubSection, Product, ProductImage, Cart, CartItem, OrderEvent, Alert, DeviceToken, brand
+from .outbox import drain_outbox
+from .search import get_search_backend
+from .suggest import SuggestionIndex
+from .tasks import dispatch_pending_alerts
+from .telegram_utility import MAX_MESSAGE_LENGTH, TelegramNotifier, build_digests
+from .utility import deliver_otp, get_otp_status
+
+
+class CatalogTestCase(TestCase):
+    """
+    Provides the section and subsection most catalog tests hang products on.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.section = Section.objects.create(name="Test Section")
+        cls.subsection = SubSection.objects.create(section=cls.section, name="Test Subsection")
+
+
+class CatalogCacheTests(CatalogTestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(
+            sub_section=self.subsection,
+            title="Test Product",
+            price=100,
+            quantity=10
+        )
+
+    def test_list_is_served_from_cache(self):
+        url = reverse('product-list')
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['title'], "Test Product")
+
+    def test_save_invalidates_cached_list(self):
+        url = reverse('product-list')
+        self.client.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.title = "Renamed Product"
+            self.product.save()
+
+        response = self.client.get(url)
+        self.assertEqual(response.json()['results'][0]['title'], "Renamed Product")
+
+
+class ConditionalGetTests(CatalogTestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(
+            sub_section=self.subsection,
+            title="Test Product",
+            price=100,
+            quantity=10
+        )
+
+    def test_matching_etag_returns_304(self):
+        url = reverse('product-detail', args=[self.product.pk])
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_etag_changes_after_save(self):
+        url = reverse('product-detail', args=[self.product.pk])
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_cart_etag_changes_when_items_change(self):
+        response = self.client.post(
+            reverse('cart-add'),
+            {'products': [{'product_id': self.product.pk, 'quantity': 1}]},
+            content_type='application/json',
+        )
+        cart_id = response.json()['cart_id']
+        url = reverse('cart-view') + f'?cart_id={cart_id}'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.client.post(
+            reverse('cart-add'),
+            {'cart_id': cart_id, 'products': [{'product_id': self.product.pk, 'quantity': 2}]},
+            content_type='application/json',
+        )
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_unknown_carts_get_no_version(self):
+        cart_id = "5b7c1a52-3f0e-4a53-9d1e-0c2a6f1e8b11"
+        response = self.client.get(reverse('cart-view') + f'?cart_id={cart_id}')
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(cache.get(f"cart:version:{cart_id}"))
+
+
+class KeysetPaginationTests(CatalogTestCase):
+    def setUp(self):
+        cache.clear()
+        # Duplicate prices make sure ties are broken by id across page boundaries
+        for i in range(25):
+            Product.objects.create(
+                sub_section=self.subsection,
+                title=f"Product {i:02d}",
+                price=10 + i % 3,
+                quantity=5
+            )
+
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            body = response.json()
+            self.assertNotIn('count', body)
+            ids.extend(product['id'] for product in body['results'])
+            url = body['next']
+        return ids
+
+    def test_cursor_pages_cover_catalog_in_order(self):
+        ids = self.walk(reverse('product-list') + '?pagination=cursor&ordering=price')
+        expected = list(Product.objects.order_by('price', 'id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_descending_cursor_pages(self):
+        ids = self.walk(reverse('product-list') + '?pagination=cursor&ordering=-title&page_size=7')
+        expected = list(Product.objects.order_by('-title', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse('product-list') + '?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+
+class QueryCountTests(CatalogTestCase):
+    """
+    Query counts must not grow with the number of rows serialized.
+    """
+    def setUp(self):
+        cache.clear()
+        self.brand = brand.objects.create(brand_name="Test Brand")
+        self.products = []
+        for i in range(5):
+            product = Product.objects.create(
+                sub_section=self.subsection,
+                brand=self.brand,
+                title=f"Product {i}",
+                price=100,
+                quantity=10
+            )
+            ProductImage.objects.create(product=product, image=f"product_images/{i}.png")
+            ProductImage.objects.create(product=product, image=f"product_images/{i}b.png")
+            self.products.append(product)
+
+    def test_product_list(self):
+        # count, products (+brand, sub_section), images
+        with self.assertNumQueries(3):
+            self.client.get(reverse('product-list'))
+
+    def test_product_detail(self):
+        with self.assertNumQueries(2):
+            self.client.get(reverse('product-detail', args=[self.products[0].pk]))
+
+    def test_subsection_detail(self):
+        url = reverse('section-subsections-detail', args=[self.subsection.section_id, self.subsection.pk])
+        with self.assertNumQueries(3):
+            self.client.get(url)
+
+    def test_brand_detail(self):
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('brand-detail', args=[self.brand.pk]))
+        # image_variants stays internal; clients get the srcset built from it
+        self.assertEqual(list(response.json()), ['id', 'brand_name', 'brand_image', 'srcset', 'products'])
+
+    def test_cart_view(self):
+        cart = Cart.objects.create()
+        for product in self.products:
+            CartItem.objects.create(cart=cart, product=product, quantity=1)
+        # exists, then cart (+coupon), items (+products, brand, sub_section), images
+        with self.assertNumQueries(4):
+            self.client.get(reverse('cart-view') + f'?cart_id={cart.cart_id}')
+
+
+class EffectivePriceTests(CatalogTestCase):
+    def setUp(self):
+        cache.clear()
+        self.plain = Product.objects.create(sub_section=self.subsection, title="Plain", price=50, quantity=1)
+        self.fixed = Product.objects.create(
+            sub_section=self.subsection, title="Fixed", price=80, quantity=1,
+            discount_type=Product.FIXED, discount_value=45
+        )
+        self.percentage = Product.objects.create(
+            sub_section=self.subsection, title="Percentage", price=99, quantity=1,
+            discount_type=Product.PERCENTAGE, discount_value=15
+        )
+
+    def test_annotation_matches_python_calculation(self):
+        for product in Product.objects.with_effective_price():
+            self.assertEqual(product.effective_price, product.calculate_discounted_price())
+
+    def test_order_and_filter_by_effective_price(self):
+        response = self.client.get(reverse('product-list') + '?ordering=-effective_price')
+        titles = [product['title'] for product in response.json()['results']]
+        self.assertEqual(titles, ["Percentage", "Plain", "Fixed"])
+
+        response = self.client.get(reverse('product-list') + '?effective_price__gte=40&effective_price__lte=60')
+        titles = [product['title'] for product in response.json()['results']]
+        self.assertEqual(titles, ["Plain"])
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        section = Section.objects.create(name="ملابس")
+        subsection = SubSection.objects.create(section=section, name="قمصان")
+        self.brand = brand.objects.create(brand_name="الأمير")
+        self.shirt = Product.objects.create(
+            sub_section=subsection, brand=self.brand, title="قَمِيص أحمر", price=10, quantity=1
+        )
+        self.dress = Product.objects.create(
+            sub_section=subsection, title="فستان", description="لون أحمر", price=10, quantity=1
+        )
+
+    def search(self, term):
+        response = self.client.get(reverse('product-list'), {'search': term})
+        return [product['id'] for product in response.json()['results']]
+
+    def test_normalizes_tashkeel_and_alef(self):
+        self.assertEqual(self.search("قميص احمر"), [self.shirt.pk])
+
+    def test_title_matches_rank_first(self):
+        self.assertEqual(self.search("احمر"), [self.shirt.pk, self.dress.pk])
+
+    def test_ranks_and_pages_every_match_in_sql(self):
+        subsection = self.shirt.sub_section
+        Product.objects.bulk_create([
+            Product(sub_section=subsection, title=f"قميص {i}", price=10, quantity=1) for i in range(30)
+        ])
+        get_search_backend().index(Product.objects.all())
+        seen = []
+        for page in range(1, 5):
+            body = self.client.get(reverse('product-list'), {'search': "قميص", 'page': page}).json()
+            self.assertEqual(body['count'], 31)
+            seen.extend(product['id'] for product in body['results'])
+        self.assertEqual(sorted(seen), sorted(Product.objects.exclude(pk=self.dress.pk).values_list('pk', flat=True)))
+
+    def test_index_follows_related_changes(self):
+        self.assertEqual(self.search("الامير"), [self.shirt.pk])
+        self.brand.brand_name = "النجمة"
+        self.brand.save()
+        cache.clear()
+        self.assertEqual(self.search("الامير"), [])
+        self.assertEqual(self.search("النجمه"), [self.shirt.pk])
+
+        self.shirt.delete()
+        cache.clear()
+        self.assertEqual(self.search("احمر"), [self.dress.pk])
+
+
+class SuggestTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        # Rebuild on the request thread so the test database is visible
+        patcher = mock.patch.object(SuggestionIndex, 'background_refresh', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        section = Section.objects.create(name="ملابس")
+        subsection = SubSection.objects.create(section=section, name="قمصان")
+        self.brand = brand.objects.create(brand_name="الأمير")
+        self.shirt = Product.objects.create(
+            sub_section=subsection, brand=self.brand, title="قميص أحمر", price=10, quantity=1
+        )
+        self.red = Product.objects.create(sub_section=subsection, title="أحذية", price=10, quantity=1)
+
+    def suggest(self, q, **params):
+        response = self.client.get(reverse('product-suggest'), {'q': q, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_prefix_matches_titles_words_and_brands(self):
+        self.assertEqual(self.suggest("قم"), [{'id': self.shirt.pk, 'title': "قميص أحمر", 'brand_name': "الأمير"}])
+        # Title prefixes rank ahead of matches on a later word
+        self.assertEqual([s['id'] for s in self.suggest("اح")], [self.red.pk, self.shirt.pk])
+        self.assertEqual([s['id'] for s in self.suggest("الام")], [self.shirt.pk])
+
+    def test_index_follows_product_changes(self):
+        self.suggest("قم")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shirt.title = "بنطلون"
+            self.shirt.save()
+        self.assertEqual(self.suggest("قم"), [])
+        self.assertEqual([s['id'] for s in self.suggest("بنط")], [self.shirt.pk])
+
+    def test_stock_and_price_changes_leave_the_index_alone(self):
+        self.suggest("قم")
+        version = get_suggestion_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shirt.update_stock(-1)
+            self.shirt.price = 12
+            self.shirt.save()
+        self.assertEqual(get_suggestion_version(), version)
+
+    def test_rebuilds_for_changes_made_elsewhere(self):
+        self.suggest("قم")
+        # Another process renames the product; only the version reaches us
+        Product.objects.filter(pk=self.shirt.pk).update(title="بنطلون")
+        bump_suggestion_version()
+        self.assertEqual(self.suggest("قم"), [])
+        self.assertEqual([s['id'] for s in self.suggest("بنط")], [self.shirt.pk])
+
+    def test_ranks_before_truncating(self):
+        subsection = self.shirt.sub_section
+        # Title-word matches whose keys sort ahead of the title match
+        for i in range(30):
+            Product.objects.create(sub_section=subsection, title=f"ب{i} احب", price=10, quantity=1)
+        self.assertEqual([s['id'] for s in self.suggest("اح", limit=1)], [self.red.pk])
+
+    def test_serves_old_index_while_refreshing_in_background(self):
+        self.suggest("قم")
+        Product.objects.filter(pk=self.shirt.pk).update(title="بنطلون")
+        bump_suggestion_version()
+        with mock.patch.object(SuggestionIndex, 'background_refresh', True), \
+                mock.patch('api.suggest.threading.Thread') as thread:
+            self.assertEqual([s['id'] for s in self.suggest("قم")], [self.shirt.pk])
+            # A second stale request doesn't start another rebuild
+            self.suggest("قم")
+        thread.assert_called_once()
+        thread.return_value.start.assert_called_once_with()
+        thread.call_args.kwargs['target']()
+        self.assertEqual(self.suggest("قم"), [])
+
+
+class AddToCartTests(CatalogTestCase):
+    def setUp(self):
+        cache.clear()
+        self.products = [
+            Product.objects.create(sub_section=self.subsection, title=f"Product {i}", price=10, quantity=5)
+            for i in range(20)
+        ]
+
+    def add(self, lines, cart_id=None):
+        data = {'products': lines}
+        if cart_id:
+            data['cart_id'] = cart_id
+        return self.client.post(reverse('cart-add'), data, content_type='application/json')
+
+    def test_upserts_all_lines_in_constant_queries(self):
+        lines = [{'product_id': product.pk, 'quantity': 2} for product in self.products]
+        # products, savepoint, cart insert, item upsert, release,
+        # then cart, items (+products) and images for the response
+        with self.assertNumQueries(8):
+            response = self.add(lines)
+        self.assertEqual(response.status_code, 201)
+        cart_id = response.json()['cart_id']
+
+        response = self.add([{'product_id': self.products[0].pk, 'quantity': 4}], cart_id)
+        self.assertEqual(response.status_code, 201)
+        cart = Cart.objects.get(cart_id=cart_id)
+        self.assertEqual(cart.items.count(), 20)
+        self.assertEqual(cart.items.get(product=self.products[0]).quantity, 4)
+
+    def test_rejects_whole_request_on_missing_product(self):
+        response = self.add([
+            {'product_id': self.products[0].pk, 'quantity': 1},
+            {'product_id': 999999, 'quantity': 1},
+        ])
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_rejects_non_positive_quantities(self):
+        for quantity in (0, -1):
+            response = self.add([{'product_id': self.products[0].pk, 'quantity': quantity}])
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Cart.objects.exists())
+
+
+@override_settings(CART_STORE='api.cart_store.CacheCartStore')
+class CacheCartStoreTests(CatalogTestCase):
+    def setUp(self):
+        cache.clear()
+        self.products = [
+            Product.objects.create(sub_section=self.subsection, title=f"Product {i}", price=10, quantity=5)
+            for i in range(3)
+        ]
+
+    def test_cart_lives_in_cache_only(self):
+        response = self.client.post(
+            reverse('cart-add'),
+            {'products': [{'product_id': product.pk, 'quantity': 2} for product in self.products]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 201)
+        cart_id = response.json()['cart_id']
+        self.assertFalse(Cart.objects.exists())
+
+        self.client.post(
+            reverse('cart-add'),
+            {'cart_id': cart_id, 'products': [{'product_id': self.products[0].pk, 'quantity': 1}]},
+            content_type='application/json',
+        )
+        body = self.client.get(reverse('cart-view') + f'?cart_id={cart_id}').json()
+        self.assertEqual([item['quantity'] for item in body['items']], [1, 2, 2])
+        self.assertEqual(body['total'], 50)
+
+    def test_unknown_cart_is_not_found(self):
+        response = self.client.get(reverse('cart-view') + '?cart_id=not-a-uuid')
+        self.assertEqual(response.status_code, 404)
+
+    def test_expired_cart_is_not_found_when_adding(self):
+        store = CacheCartStore()
+        cart_id = store.set_items(None, {self.products[0].pk: 1})
+        cache.delete(store._key(cart_id))
+        self.assertIsNone(store.set_items(cart_id, {self.products[1].pk: 1}))
+
+    def test_writes_wait_for_the_cart_lock(self):
+        store = CacheCartStore()
+        store.lock_timeout = 0
+        cart_id = store.set_items(None, {self.products[0].pk: 1})
+        cache.add(f"cart:lock:{cart_id}", 1)
+        with self.assertRaises(CartLocked):
+            store.set_items(cart_id, {self.products[1].pk: 1})
+        cache.delete(f"cart:lock:{cart_id}")
+        store.set_items(cart_id, {self.products[1].pk: 2})
+        self.assertEqual(cache.get(store._key(cart_id))['items'], {self.products[0].pk: 1, self.products[1].pk: 2})
+
+    def test_cart_is_deleted_only_when_the_order_commits(self):
+        store = CacheCartStore()
+        cart_id = store.set_items(None, {self.products[0].pk: 1})
+        with self.captureOnCommitCallbacks() as callbacks:
+            store.delete(store.load(cart_id))
+        self.assertTrue(store.exists(cart_id))
+        for callback in callbacks:
+            callback()
+        self.assertFalse(store.exists(cart_id))
+
+
+class ReapCartsTests(CatalogTestCase):
+    def setUp(self):
+        self.product = Product.objects.create(sub_section=self.subsection, title="Product", price=10, quantity=5)
+
+    def test_deletes_only_old_carts_in_batches(self):
+        carts = [Cart.objects.create() for _ in range(5)]
+        for cart in carts:
+            CartItem.objects.create(cart=cart, product=self.product, quantity=1)
+        Cart.objects.filter(pk__in=[cart.pk for cart in carts[:3]]).update(
+            created_at=timezone.now() - timedelta(days=40)
+        )
+
+        out = StringIO()
+        call_command('reap_carts', days=30, batch_size=2, stdout=out)
+
+        self.assertIn("api.Cart: 3", out.getvalue())
+        self.assertIn("api.CartItem: 3", out.getvalue())
+        self.assertEqual(set(Cart.objects.all()), set(carts[3:]))
+
+
+class StockReservationTests(CatalogTestCase):
+    def setUp(self):
+        self.a = Product.objects.create(sub_section=self.subsection, title="A", price=10, quantity=5)
+        self.b = Product.objects.create(sub_section=self.subsection, title="B", price=10, quantity=1)
+        self.c = Product.objects.create(sub_section=self.subsection, title="C", price=10, quantity=0)
+
+    def test_reserves_all_products(self):
+        Product.objects.reserve_stock({self.b.pk: 1, self.a.pk: 3})
+        self.a.refresh_from_db()
+        self.b.refresh_from_db()
+        self.assertEqual((self.a.quantity, self.b.quantity), (2, 0))
+
+    def test_reports_every_short_product_and_changes_nothing(self):
+        with self.assertRaises(ValidationError) as raised:
+            Product.objects.reserve_stock({self.a.pk: 5, self.b.pk: 2, self.c.pk: 1})
+        self.assertEqual(len(raised.exception.messages), 2)
+        self.assertIn("B", raised.exception.messages[0])
+        self.a.refresh_from_db()
+        self.assertEqual(self.a.quantity, 5)
+
+
+delivered_orders = []
+
+
+def recording_sink(orders):
+    delivered_orders.extend(order.pk for order in orders)
+    return {}
+
+
+def failing_sink(orders):
+    return {order.pk: "unavailable" for order in orders}
+
+
+def leased_sink(orders):
+    # The claim is committed before the sink runs, so the row is already leased
+    delivered_orders.extend(
+        OrderEvent.objects.filter(order__in=orders, next_attempt_at__gt=timezone.now()).values_list('order_id', flat=True)
+    )
+    return {}
+
+
+@override_settings(ORDER_EVENT_SINKS={'test': 'api.tests.recording_sink'})
+class OrderOutboxTests(CatalogTestCase):
+    def setUp(self):
+        cache.clear()
+        delivered_orders.clear()
+        self.product = Product.objects.create(sub_section=self.subsection, title="Product", price=10, quantity=5)
+
+    def purchase(self):
+        response = self.client.post(
+            reverse('cart-add'),
+            {'products': [{'product_id': self.product.pk, 'quantity': 2}]},
+            content_type='application/json',
+        )
+        cache.set("otp:+9647700000000", 123456)
+        return self.client.post(reverse('cart-verify-otp'), {
+            'cart_id': response.json()['cart_id'],
+            'username': "Test",
+            'government': "Baghdad",
+            'address': "Street",
+            'phone_number': "+9647700000000",
+            'code': "123456",
+        }, content_type='application/json')
+
+    def test_order_writes_event_and_drain_delivers_it(self):
+        self.assertEqual(self.purchase().status_code, 201)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 3)
+        event = OrderEvent.objects.get()
+        self.assertEqual(event.status, OrderEvent.PENDING)
+
+        self.assertEqual(drain_outbox(), 1)
+        event.refresh_from_db()
+        self.assertEqual(event.status, OrderEvent.SENT)
+        self.assertEqual(delivered_orders, [event.order_id])
+
+    @override_settings(ORDER_EVENT_SINKS={'test': 'api.tests.leased_sink'})
+    def test_events_are_leased_while_sinks_run(self):
+        self.purchase()
+        self.assertEqual(drain_outbox(), 1)
+        event = OrderEvent.objects.get()
+        self.assertEqual(delivered_orders, [event.order_id])
+        self.assertEqual(event.status, OrderEvent.SENT)
+
+    @override_settings(ORDER_EVENT_SINKS={'test': 'api.tests.failing_sink'})
+    def test_failed_delivery_is_retried_later(self):
+        self.purchase()
+        drain_outbox()
+        event = OrderEvent.objects.get()
+        self.assertEqual((event.status, event.attempts, event.last_error), (OrderEvent.PENDING, 1, "unavailable"))
+        self.assertGreater(event.next_attempt_at, timezone.now())
+        # Not due yet, so a second drain leaves it alone
+        self.assertEqual(drain_outbox(), 0)
+
+
+class TelegramNotifierTests(TestCase):
+    def test_digests_pack_orders_under_message_limit(self):
+        entries = [(1, "a" * 3000), (2, "b" * 3000), (3, "c" * 100), (4, "d\n" * 3000)]
+        digests = build_digests(entries)
+        self.assertEqual([keys for _, keys in digests], [[1], [2, 3], [4], [4]])
+        self.assertTrue(all(len(text) <= MAX_MESSAGE_LENGTH for text, _ in digests))
+
+    def test_waits_out_rate_limit(self):
+        notifier = TelegramNotifier("token", "chat", messages_per_minute=6000)
+        limited = mock.Mock(status_code=429)
+        limited.json.return_value = {'ok': False, 'parameters': {'retry_after': 2}}
+        sent = mock.Mock(status_code=200)
+        with mock.patch.object(notifier.session, 'post', side_effect=[limited, sent]) as post, \
+                mock.patch('api.telegram_utility.time.sleep') as sleep:
+            notifier.send_message("hello")
+        self.assertEqual(post.call_count, 2)
+        sleep.assert_called_with(2)
+
+    def send_orders(self, notifier, texts, failing):
+        orders = [mock.Mock(pk=pk, text=text) for pk, text in texts.items()]
+        sent = []
+
+        def send_message(text):
+            if text in failing:
+                raise requests.ConnectionError("boom")
+            sent.append(text)
+
+        with mock.patch('api.telegram_utility.format_order', side_effect=lambda customer, order: order.text), \
+                mock.patch.object(notifier, 'send_message', side_effect=send_message):
+            return notifier.send_orders(orders), sent
+
+    def test_failed_digest_falls_back_to_single_orders(self):
+        cache.clear()
+        notifier = TelegramNotifier("token", "chat")
+        texts = {1: "one", 2: "two", 3: "three"}
+        digest = build_digests(texts.items())[0][0]
+        failures, sent = self.send_orders(notifier, texts, {digest, "two"})
+        self.assertEqual(list(failures), [2])
+        self.assertEqual(sent, ["one", "three"])
+
+    def test_retry_sends_only_the_unsent_parts_of_a_long_order(self):
+        cache.clear()
+        notifier = TelegramNotifier("token", "chat")
+        texts = {1: "a\n" * 3000}
+        first, second = [text for text, _ in build_digests(texts.items())]
+        failures, sent = self.send_orders(notifier, texts, {second})
+        self.assertEqual((list(failures), sent), ([1], [first]))
+        failures, sent = self.send_orders(notifier, texts, set())
+        self.assertEqual((failures, sent), ({}, [second]))
+
+
+def multicast_response(multicast, dry_run=False, app=None):
+    # The first token of each batch is dead, the second fails transiently
+    errors = {0: messaging.UnregisteredError("unregistered"), 1: Exception("unavailable")}
+    return mock.Mock(responses=[
+        mock.Mock(exception=errors.get(i)) for i in range(len(multicast.tokens))
+    ])
+
+
+class BroadcastTests(TestCase):
+    def setUp(self):
+        DeviceToken.objects.bulk_create(
+            [DeviceToken(token=f"android-{i}", platform='android') for i in range(1200)]
+            + [DeviceToken(token=f"ios-{i}", platform='ios') for i in range(3)]
+        )
+
+    def test_saving_alert_only_queues_it(self):
+        with mock.patch('api.tasks.send_alert.delay') as delay, \
+                mock.patch('firebase_admin.messaging.send_each_for_multicast') as fcm:
+            with self.captureOnCommitCallbacks(execute=True):
+                alert = Alert.objects.create(title="Sale", message="Everything is half price")
+        delay.assert_called_once_with(alert.pk)
+        fcm.assert_not_called()
+        self.assertEqual(alert.status, Alert.PENDING)
+
+    def test_alert_broadcast_batches_and_records_progress(self):
+        alert = Alert.objects.create(title="Sale", message="Everything is half price")
+        with mock.patch('firebase_admin.messaging.send_each_for_multicast', side_effect=multicast_response) as fcm, \
+                mock.patch('api.broadcast.get_firebase_app'), \
+                mock.patch.object(APNsSender, 'send_batch', side_effect=lambda tokens, *args: [(t, None) for t in tokens]):
+            broadcast_alert(alert.pk)
+            # A second delivery of the same job finds it already claimed
+            self.assertIsNone(broadcast_alert(alert.pk))
+
+        alert.refresh_from_db()
+        self.assertEqual([len(call.args[0].tokens) for call in fcm.call_args_list], [500, 500, 200])
+        self.assertEqual(alert.status, Alert.SENT)
+        self.assertTrue(alert.is_sent)
+        self.assertEqual(
+            (alert.total_count, alert.sent_count, alert.failed_count, alert.pruned_count),
+            (1203, 1197, 6, 3)
+        )
+        self.assertEqual(
+            set(DeviceToken.objects.filter(is_active=False).values_list('token', flat=True)),
+            {"android-0", "android-500", "android-1000"}
+        )
+
+    def test_saving_an_alert_leaves_broadcast_progress_alone(self):
+        with mock.patch('api.tasks.send_alert.delay'):
+            alert = Alert.objects.create(title="Sale", message="Everything is half price")
+        # A worker moves on while an admin form holds the old row
+        Alert.objects.filter(pk=alert.pk).update(status=Alert.SENDING, sent_count=500, last_token_id=500)
+        alert.title = "Big sale"
+        alert.save()
+        alert.refresh_from_db()
+        self.assertEqual(
+            (alert.title, alert.status, alert.sent_count, alert.last_token_id),
+            ("Big sale", Alert.SENDING, 500, 500)
+        )
+
+    def test_stalled_broadcast_resumes_from_its_cursor(self):
+        alert = Alert.objects.create(title="Sale", message="Everything is half price")
+        # A worker died after its first batch and stopped beating
+        Alert.objects.filter(pk=alert.pk).update(
+            status=Alert.SENDING, started_at=timezone.now(), total_count=1203, sent_count=498, failed_count=2,
+            last_platform='android', last_token_id=DeviceToken.objects.get(token="android-499").pk,
+            heartbeat_at=timezone.now() - timedelta(hours=1),
+        )
+        with mock.patch('api.tasks.send_alert.delay') as delay:
+            dispatch_pending_alerts()
+        delay.assert_called_once_with(alert.pk)
+
+        with mock.patch('firebase_admin.messaging.send_each_for_multicast', side_effect=multicast_response) as fcm, \
+                mock.patch('api.broadcast.get_firebase_app'), \
+                mock.patch.object(APNsSender, 'send_batch', side_effect=lambda tokens, *args: [(t, None) for t in tokens]):
+            broadcast_alert(alert.pk)
+
+        alert.refresh_from_db()
+        self.assertEqual([len(call.args[0].tokens) for call in fcm.call_args_list], [500, 200])
+        self.assertEqual(alert.status, Alert.SENT)
+        self.assertEqual((alert.sent_count, alert.failed_count), (1197, 6))
+
+
+class DeviceTokenRegistrationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def register(self, data):
+        return self.client.post(reverse('save_device_token'), data, content_type='application/json')
+
+    def test_batch_upsert_reactivates_and_skips_recent_tokens(self):
+        DeviceToken.objects.create(token="dead", platform='ios', is_active=False)
+        response = self.register([
+            {'token': "dead", 'platform': 'ios'},
+            {'token': "new", 'platform': 'android'},
+        ])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(DeviceToken.objects.filter(is_active=True).count(), 2)
+
+        # Relaunching the app right away doesn't write again
+        with self.assertNumQueries(0):
+            self.assertEqual(self.register({'token': "new", 'platform': 'android'}).status_code, 201)
+
+
+class CheckoutOTPTests(CatalogTestCase):
+    def setUp(self):
+        cache.clear()
+        product = Product.objects.create(sub_section=self.subsection, title="Product", price=10, quantity=5)
+        response = self.client.post(
+            reverse('cart-add'),
+            {'products': [{'product_id': product.pk, 'quantity': 2}]},
+            content_type='application/json',
+        )
+        self.cart_id = response.json()['cart_id']
+
+    def checkout(self):
+        return self.client.post(reverse('cart-checkout'), {
+            'cart_id': self.cart_id,
+            'username': "Test",
+            'government': "Baghdad",
+            'address': "Street",
+            'phone_number': "+9647700000000",
+        }, content_type='application/json')
+
+    def test_checkout_queues_otp_after_commit_and_throttles_resends(self):
+        with mock.patch('api.tasks.send_otp.delay') as delay, \
+                mock.patch('api.utility.get_twilio_client') as twilio:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.checkout()
+            self.assertEqual(response.status_code, 202)
+            request_id = response.json()['otp_request_id']
+            # The code is stored by the request, not by the worker
+            otp = cache.get("otp:+9647700000000")
+            delay.assert_called_once_with("+9647700000000", otp, request_id)
+            twilio.assert_not_called()
+
+            status = self.client.get(reverse('cart-otp-status', args=[request_id]))
+            self.assertEqual(status.json()['otp_status'], 'pending')
+
+            resend = self.checkout()
+            self.assertEqual(resend.status_code, 429)
+            self.assertEqual(delay.call_count, 1)
+
+    def test_worker_records_outcome(self):
+        with mock.patch('api.tasks.send_otp.delay'):
+            request_id = self.checkout().json()['otp_request_id']
+        otp = cache.get("otp:+9647700000000")
+        with mock.patch('api.utility.get_twilio_client') as twilio:
+            self.assertEqual(deliver_otp("+9647700000000", otp, request_id), 'sent')
+        self.assertIn(str(otp), twilio.return_value.messages.create.call_args.kwargs['content_variables'])
+        self.assertEqual(get_otp_status(request_id), 'sent')
+
+        with mock.patch('api.utility.get_twilio_client', side_effect=OSError("unreachable")):
+            self.assertEqual(deliver_otp("+9647700000000", otp, request_id), 'failed')
+        self.assertEqual(get_otp_status(request_id), 'failed')
+        # A failed send doesn't hold the customer back
+        with mock.patch('api.tasks.send_otp.delay'):
+            self.assertEqual(self.checkout().status_code, 202)
+
+
+def png_upload(name="logo.png", size=(900, 300)):
+    buffer = BytesIO()
+    image = Image.new('RGBA', size, (200, 30, 30, 128))
+    exif = Image.Exif()
+    exif[0x010F] = "Camera"
+    image.save(buffer, 'PNG', exif=exif)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class ImageVariantTests(CatalogTestCase):
+    def setUp(self):
+        cache.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root, IMAGE_VARIANT_WIDTHS=[160, 640, 1280])
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.product = Product.objects.create(sub_section=self.subsection, title="Product", price=10, quantity=5)
+
+    def test_upload_builds_resized_stripped_variants(self):
+        with mock.patch('api.tasks.build_image_variants.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                image = ProductImage.objects.create(product=self.product, image=png_upload())
+        # The request only queues the work
+        delay.assert_called_once_with('api.ProductImage', image.pk)
+        self.assertEqual(image.image_variants, {})
+        generate_image_variants(ProductImage, image.pk)
+        image.refresh_from_db()
+        variants = image.image_variants
+        self.assertEqual(variants['source'], image.image.name)
+        # Never upscaled past the 900px source
+        self.assertEqual(list(variants['webp']), ['160', '640', '900'])
+        with default_storage.open(variants['jpeg']['160']) as variant, Image.open(variant) as opened:
+            self.assertEqual((opened.format, opened.size), ('JPEG', (160, 53)))
+            self.assertEqual(len(opened.getexif()), 0)
+
+        payload = self.client.get(reverse('product-detail', args=[self.product.pk])).json()['images'][0]
+        self.assertTrue(payload['srcset']['webp']['640'].startswith("http://testserver/media/derivatives/product_images/"))
+        # Half-transparent red over white
+        self.assertEqual(payload['placeholder']['color'], "#e38e8e")
+        lqip = base64.b64decode(payload['placeholder']['lqip'].removeprefix("data:image/webp;base64,"))
+        with Image.open(BytesIO(lqip)) as opened:
+            self.assertEqual(opened.size, (16, 5))
+
+        # Saving without touching the image does no image work
+        with self.captureOnCommitCallbacks() as callbacks:
+            ProductImage.objects.get(pk=image.pk).save()
+        self.assertNotIn(generate_image_variants, [callback.func for callback in callbacks])
+
+    def test_rebuild_command_skips_up_to_date_rows(self):
+        image = ProductImage.objects.create(product=self.product, image=png_upload())
+        Banner.objects.create(image=png_upload("banner.png", size=(100, 100)), section=self.product.sub_section.section)
+        out = StringIO()
+        call_command('rebuild_image_derivatives', workers=1, stdout=out)
+        self.assertIn("api.productimage: 1 built", out.getvalue())
+        image.refresh_from_db()
+        self.assertEqual(list(image.image_variants['jpeg']), ['160', '640', '900'])
+        self.assertEqual(list(Banner.objects.get().image_variants['webp']), ['100'])
+
+        out = StringIO()
+        call_command('rebuild_image_derivatives', workers=1, model=['api.ProductImage'], stdout=out)
+        self.assertIn("api.productimage: 0 built", out.getvalue())
+
+        # Maps from before placeholders existed are rebuilt
+        ProductImage.objects.update(image_variants={'source': image.image.name, 'webp': {}})
+        out = StringIO()
+        call_command('rebuild_image_derivatives', workers=1, model=['api.ProductImage'], stdout=out)
+        self.assertIn("api.productimage: 1 built", out.getvalue())
+
+
+@override_settings(MEDIA_ACCEL_REDIRECT='')
+class HashedMediaTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_identical_uploads_share_one_hashed_file(self):
+        first = default_storage.save("product_images/Untitled.PNG", ContentFile(b"same bytes"))
+        second = default_storage.save("product_images/download_1.png", ContentFile(b"same bytes"))
+        other = default_storage.save("product_images/Untitled.PNG", ContentFile(b"other bytes"))
+        self.assertEqual(first, second)
+        self.assertRegex(first, r"^product_images/[0-9a-f]{20}\.png$")
+        self.assertNotEqual(first, other)
+
+    def test_hashed_media_is_immutable(self):
+        name = default_storage.save("banner_images/banner.png", ContentFile(b"banner"))
+        # Saved before uploads were named by content
+        with open(os.path.join(self.media_root, "legacy.png"), 'wb') as legacy:
+            legacy.write(b"legacy")
+
+        response = self.client.get(f"/media/{name}")
+        self.assertEqual(b"".join(response.streaming_content), b"banner")
+        self.assertEqual(response['Cache-Control'], "public, max-age=31536000, immutable")
+        self.assertEqual(self.client.get("/media/legacy.png")['Cache-Control'], "public, max-age=3600")
+        self.assertEqual(self.client.get("/media/../core/settings.py").status_code, 404)
+
+        with override_settings(MEDIA_ACCEL_REDIRECT='/protected-media/'):
+            response = self.client.get(f"/media/{name}")
+        self.assertEqual(response['X-Accel-Redirect'], f"/protected-media/{name}")
+        self.assertEqual(response.content, b"")
+
+
+class CatalogImportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        settings_override = override_settings(MEDIA_ROOT=os.path.join(self.tmp, 'media'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        phones = Section.objects.create(name="Phones")
+        self.android = SubSection.objects.create(section=phones, name="Android")
+        SubSection.objects.create(section=Section.objects.create(name="Tablets"), name="Android")
+        samsung = brand.objects.create(brand_name="Samsung")
+        Product.objects.create(sku="S1", sub_section=self.android, brand=samsung, title="Old", price=5, quantity=1)
+        with open(os.path.join(self.tmp, 'a.png'), 'wb') as image:
+            image.write(png_upload().read())
+
+    def import_csv(self, rows):
+        path = os.path.join(self.tmp, 'feed.csv')
+        with open(path, 'w', newline='', encoding='utf-8') as feed:
+            writer = csv.writer(feed)
+            writer.writerow(['sku', 'title', 'price', 'quantity', 'brand', 'section', 'sub_section', 'images'])
+            writer.writerows(rows)
+        out, err = StringIO(), StringIO()
+        call_command('import_catalog', path, batch_size=2, images_dir=self.tmp, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_import_upserts_in_batches_and_is_repeatable(self):
+        rows = [
+            ['S1', "Galaxy", "99.50", "3", "Samsung", "Phones", "Android", "a.png"],
+            ['S2', "Lumia", "50", "7", "Nokia", "Phones", "Android", ""],
+            ['S3', "Broken", "cheap", "1", "", "Phones", "Android", ""],
+            ['S4', "Ambiguous", "10", "1", "", "", "Android", ""],
+        ]
+        with mock.patch('api.tasks.build_image_variants.delay') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            out, err = self.import_csv(rows)
+        self.assertIn("created: 1, updated: 1, images: 1, skipped: 2", out)
+        # bulk_create skips post_save, so the importer queues the variants
+        delay.assert_called_once_with('api.ProductImage', ProductImage.objects.get().pk)
+        self.assertIn("line 4: price", err)
+        self.assertIn("line 5: sub_section 'Android' exists in several sections", err)
+        galaxy = Product.objects.get(sku="S1")
+        self.assertEqual((galaxy.title, galaxy.price, galaxy.images.count()), ("Galaxy", Decimal("99.50"), 1))
+        self.assertEqual(Product.objects.get(sku="S2").brand.brand_name, "Nokia")
+        # Bulk writes skip the signals, so the importer indexes them itself
+        response = self.client.get(reverse('product-list'), {'search': "lumia"})
+        self.assertEqual([product['title'] for product in response.json()['results']], ["Lumia"])
+
+        # Importing the same feed again changes nothing
+        out, _ = self.import_csv(rows)
+        self.assertIn("created: 0, updated: 2, images: 0", out)
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(ProductImage.objects.count(), 1)
+
+    def test_export_round_trips(self):
+        self.import_csv([['S1', "Galaxy", "99.50", "3", "Samsung", "Phones", "Android", "a.png"]])
+        path = os.path.join(self.tmp, 'catalog.jsonl')
+        call_command('export_catalog', path, stdout=StringIO())
+        with open(path, encoding='utf-8') as exported:
+            row = json.loads(exported.readline())
+        self.assertEqual((row['sku'], row['price'], row['section']), ("S1", "99.50", "Phones"))
+        self.assertEqual(len(row['images']), 1)
+
+        out = StringIO()
+        call_command('import_catalog', path, stdout=out, stderr=StringIO())
+        self.assertIn("created: 0, updated: 1, images: 0, skipped: 0", out.getvalue())
+
+    def test_fetches_image_urls(self):
+        importer = CatalogImporter()
+        response = mock.Mock(content=png_upload().read(), headers={'Content-Type': 'image/png'})
+        with mock.patch.object(importer.session, 'get', return_value=response):
+            name = importer.fetch_image("https://cdn.example.com/p/1.png?v=2")
+        self.assertRegex(name, r"^product_images/[0-9a-f]{20}\.png$")
+
+    def test_local_paths_must_be_images_under_images_dir(self):
+        with open(os.path.join(self.tmp, 'notes.png'), 'w') as fake:
+            fake.write("not an image")
+        outside = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
+        self.addCleanup(os.remove, outside.name)
+        outside.write(png_upload().read())
+        outside.close()
+        rows = [
+            ['S5', "Galaxy", "99.50", "3", "", "Phones", "Android", os.path.join(self.tmp, 'a.png')],
+            ['S6', "Note", "10", "1", "", "Phones", "Android", "notes.png"],
+            ['S7', "Pixel", "10", "1", "", "Phones", "Android", outside.name],
+        ]
+        out, err = self.import_csv(rows)
+        self.assertIn("created: 2, updated: 0, images: 1, skipped: 1", out)
+        self.assertIn(f"line 4: Image '{outside.name}'", err)
+        self.assertEqual(Product.objects.get(sku="S5").images.count(), 1)
+        self.assertFalse(Product.objects.get(sku="S6").images.exists())
+
+    def test_rejected_rows_create_no_brands(self):
+        rows = [
+            ['S5', "Galaxy", "99.50", "3", "Xiaomi", "Phones", "Android", "../../etc/passwd"],
+            ['S2', "Broken", "cheap", "1", "Nokia", "Phones", "Android", ""],
+        ]
+        out, err = self.import_csv(rows)
+        self.assertIn("created: 0, updated: 0, images: 0, skipped: 2", out)
+        self.assertIn("line 2: Image '../../etc/passwd'", err)
+        self.assertEqual(list(brand.objects.values_list('brand_name', flat=True)), ["Samsung"])
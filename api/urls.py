@@ -11,6 +11,7 @@ from .views import (
     ApplyCouponView,
     CheckoutView,
     VerifyOTPAndPurchaseView,
+    OTPStatusView,
     save_device_token,
     BrandViewSet,
     send_notification,
@@ -43,6 +44,7 @@ urlpatterns = [
     path('cart/view/', ViewCartView.as_view(), name='cart-view'),
     path('cart/apply-coupon/', ApplyCouponView.as_view(), name='cart-apply-coupon'),
     path('cart/checkout/', CheckoutView.as_view(), name='cart-checkout'),
+    path('cart/otp-status/<str:otp_request_id>/', OTPStatusView.as_view(), name='cart-otp-status'),
     path('cart/verify-otp/', VerifyOTPAndPurchaseView.as_view(), name='cart-verify-otp'),
     path('cart/save-device-token/', save_device_token, name='save_device_token'),
     path('cart/send-notification/', send_notification, name='send_notification'),
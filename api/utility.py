@@ -1,18 +1,55 @@
+import logging
 import random
+import threading
+
 from django.core.cache import cache
 from django.conf import settings
-from twilio.rest import Client
 
-def send_whatsapp_otp(phone_number):
+logger = logging.getLogger(__name__)
+
+OTP_PENDING = 'pending'
+OTP_SENT = 'sent'
+OTP_FAILED = 'failed'
+
+_twilio_client = None
+_twilio_lock = threading.Lock()
+
+
+def get_twilio_client():
+    """
+    The process-wide Twilio client. Its HTTP client keeps one requests
+    session, so sends reuse the connection to Twilio instead of opening one
+    per OTP. twilio is imported here so it isn't loaded at startup.
+    """
+    global _twilio_client
+    if _twilio_client is None:
+        with _twilio_lock:
+            if _twilio_client is None:
+                from twilio.rest import Client
+
+                _twilio_client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+    return _twilio_client
+
+
+def issue_otp(phone_number):
+    """
+    Generates the code and stores it for VerifyOTPAndPurchaseView. Runs in
+    the web process, so the code is in the cache the verifying request reads
+    even when the worker's cache is a different one.
+    """
     # Generate a random 6-digit OTP code
     otp = random.randint(100000, 999999)
-    
-    # Store the OTP in cache for 5 minutes (300 seconds)
-    cache.set(f"otp:{phone_number}", otp, timeout=600)
-    
-    account_sid = settings.TWILIO_ACCOUNT_SID
-    auth_token = settings.TWILIO_AUTH_TOKEN
-    client = Client(account_sid, auth_token)
+
+    # Store the OTP in cache for OTP_TIMEOUT seconds
+    cache.set(f"otp:{phone_number}", otp, timeout=settings.OTP_TIMEOUT)
+    return otp
+
+
+def send_whatsapp_otp(phone_number, otp=None):
+    if otp is None:
+        otp = issue_otp(phone_number)
+
+    client = get_twilio_client()
 
     # Replace this with your own verified WhatsApp template content SID
     # This template should have a single variable {{1}} for the OTP
@@ -30,3 +67,54 @@ def send_whatsapp_otp(phone_number):
       to=phone_number
     )
     return otp
+
+
+def _throttle_key(phone_number):
+    return f"otp-throttle:{phone_number}"
+
+
+def _status_key(request_id):
+    return f"otp:request:{request_id}"
+
+
+def claim_otp_send(phone_number):
+    """
+    Returns False when an OTP went to this number less than
+    OTP_RESEND_INTERVAL seconds ago.
+    """
+    return cache.add(_throttle_key(phone_number), 1, settings.OTP_RESEND_INTERVAL)
+
+
+def get_otp_status(request_id):
+    """
+    pending, sent or failed; None once the request has expired.
+    """
+    return cache.get(_status_key(request_id))
+
+
+def set_otp_status(request_id, status):
+    cache.set(_status_key(request_id), status, settings.OTP_TIMEOUT)
+
+
+def otp_failed(phone_number, request_id):
+    """
+    Marks the request failed and lifts the throttle so the customer can ask
+    for a new code straight away.
+    """
+    set_otp_status(request_id, OTP_FAILED)
+    cache.delete(_throttle_key(phone_number))
+
+
+def deliver_otp(phone_number, otp, request_id):
+    """
+    Sends an already issued OTP and records the outcome for the status
+    endpoint.
+    """
+    try:
+        send_whatsapp_otp(phone_number, otp)
+    except Exception:
+        logger.warning("Sending the OTP for request %s failed", request_id, exc_info=True)
+        otp_failed(phone_number, request_id)
+        return OTP_FAILED
+    set_otp_status(request_id, OTP_SENT)
+    return OTP_SENT
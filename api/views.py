@@ -1,23 +1,23 @@
+import uuid
+
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.response import Response
 from rest_framework import status, viewsets
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import status, serializers
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.filters import OrderingFilter
 from rest_framework.views import APIView
 from django.db import transaction
 from .models import (
     Section,
     SubSection,
     Product,
+    ProductImage,
     Customer,
     Order,
     OrderItem,
     Coupon,
-    Cart,
-    CartItem,
-    DeviceToken,
     brand,
     Banner
 )
@@ -34,19 +34,38 @@ from .serializers import (
     SubSectionWithProductsSerializer,
     BannerSerializer
 )
-from .utility import send_whatsapp_otp
+from .utility import OTP_PENDING, claim_otp_send, get_otp_status, issue_otp, set_otp_status
+from django.conf import settings
 from django.core.cache import cache
-from .telegram_utility import send_order_to_telegram
-from rest_framework.decorators import api_view
-from .apns import send_ios_push_notification, send_android_push_notification
+from rest_framework.decorators import action, api_view
+from .apns import send_ios_push_notification, send_android_push_notification, register_device_tokens
 from django.db import models
 from django.core.exceptions import ValidationError
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
-
-
-class BrandViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = brand.objects.prefetch_related('brand').all()
+from .caching import (
+    CatalogCacheMixin,
+    bump_cart_version,
+    delete_cart_versions,
+    get_cart_version,
+    get_catalog_versions,
+    last_modified_from,
+    make_etag,
+    not_modified_response,
+    set_validators,
+)
+from functools import partial
+from .pagination import KeysetPagination
+from .filters import ProductFilter, ProductSearchFilter
+from .suggest import suggestion_index
+from .cart_store import CartLocked, get_cart_store
+from .outbox import record_order_events
+from .tasks import enqueue_otp, schedule_outbox_drain
+
+
+class BrandViewSet(CatalogCacheMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = brand.objects.all()
+    cache_models = (brand, Product, ProductImage, SubSection)
     search_fields = ['brand_name']
 
     def get_serializer_class(self):
@@ -54,18 +73,59 @@ class BrandViewSet(viewsets.ReadOnlyModelViewSet):
             return BrandDetailSerializer
         return BrandListSerializer
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # Only the detail serializer nests the brand's products
+        if self.action == 'retrieve':
+            return queryset.prefetch_related(
+                models.Prefetch('brand', queryset=Product.objects.with_details())
+            )
+        return queryset
+
 
-class ProductViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Product.objects.prefetch_related('sub_section', 'brand').all()
+class ProductViewSet(CatalogCacheMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Product.objects.with_details().with_effective_price()
     serializer_class = ProductSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
-    filterset_fields = ['title', 'price', 'sub_section', 'brand', "is_favoured"]
+    cache_models = (Product, ProductImage, brand, SubSection)
+    filter_backends = [DjangoFilterBackend, OrderingFilter, ProductSearchFilter]
+    filterset_class = ProductFilter
     search_fields = ['title', 'description', 'brand__brand_name', 'sub_section__name']
-    ordering_fields = ['price', 'created_at']
+    ordering_fields = ['price', 'created_at', 'effective_price']
     ordering = ['title']
 
+    @property
+    def paginator(self):
+        """
+        Infinite-scroll clients opt into keyset pages with `?pagination=cursor`
+        (the `next` links keep it); everyone else gets page numbers.
+        """
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params if self.request is not None else {}
+            if params.get('pagination') == 'cursor' or KeysetPagination.cursor_query_param in params:
+                self._paginator = KeysetPagination()
+            else:
+                self._paginator = super().paginator
+        return self._paginator
 
-class SectionViewSet(viewsets.ReadOnlyModelViewSet):
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter('q', openapi.IN_QUERY, description="Typed prefix", type=openapi.TYPE_STRING),
+            openapi.Parameter('limit', openapi.IN_QUERY, description="Max suggestions (<= 20)", type=openapi.TYPE_INTEGER),
+        ]
+    )
+    @action(detail=False, methods=['get'])
+    def suggest(self, request):
+        """
+        Lightweight typeahead served from the in-memory prefix index.
+        """
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 20)
+        except ValueError:
+            limit = 10
+        return Response(suggestion_index.suggest(request.query_params.get('q', ''), limit))
+
+
+class SectionViewSet(CatalogCacheMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Section.objects.prefetch_related(
         models.Prefetch(
             'sub_sections',
@@ -75,6 +135,7 @@ class SectionViewSet(viewsets.ReadOnlyModelViewSet):
 
     pagination_class = None  # Disable pagination for sections
     search_fields = ['name']
+    cache_models = (Section, SubSection)
 
     def get_serializer_class(self):
         if self.action == 'retrieve':
@@ -82,15 +143,15 @@ class SectionViewSet(viewsets.ReadOnlyModelViewSet):
         return SectionSerializer
 
 
-class SubSectionViewSet(viewsets.ReadOnlyModelViewSet):
+class SubSectionViewSet(CatalogCacheMixin, viewsets.ReadOnlyModelViewSet):
     queryset = SubSection.objects.select_related('section').prefetch_related(
         models.Prefetch(
             'products',
-            queryset=Product.objects.select_related('brand')
-            .prefetch_related('images')
+            queryset=Product.objects.with_details()
         )
     ).all()
     search_fields = ['name']
+    cache_models = (SubSection, Product, ProductImage, brand)
 
     def get_serializer_class(self):
         if self.action == 'retrieve':
@@ -130,32 +191,40 @@ class AddToCartView(APIView):
         if not products:
             return Response({"خطأ": "يرجى إضافة منتجات إلى السلة"}, status=status.HTTP_400_BAD_REQUEST)
 
-        if cart_id:
-            try:
-                cart = Cart.objects.get(cart_id=cart_id)
-            except Cart.DoesNotExist:
-                return Response({"خطأ": "السلة غير موجودة"}, status=status.HTTP_404_NOT_FOUND)
-        else:
-            cart = Cart.objects.create()
+        cart_store = get_cart_store()
+        if cart_id and not cart_store.exists(cart_id):
+            return Response({"خطأ": "السلة غير موجودة"}, status=status.HTTP_404_NOT_FOUND)
 
+        # product_id -> quantity; a repeated product keeps its last quantity
+        lines = {}
         for product_data in products:
-            product_id = product_data.get('product_id')
-            quantity = product_data.get('quantity', 1)
-
             try:
-                product = Product.objects.get(id=product_id)
-            except Product.DoesNotExist:
-                return Response({"خطأ": f"المنتج غير موجود: {product_id}"}, status=status.HTTP_404_NOT_FOUND)
-
-            if product.quantity < quantity:
-                return Response({"خطأ": f"لا توجد كمية كافية من {product.title}"}, status=status.HTTP_400_BAD_REQUEST)
-
-            cart_item, created = CartItem.objects.update_or_create(
-                cart=cart,
-                product=product,
-                defaults={'quantity': quantity}
-            )
+                product_id = int(product_data.get('product_id'))
+                quantity = int(product_data.get('quantity', 1))
+                if quantity < 1:
+                    raise ValueError
+            except (AttributeError, TypeError, ValueError):
+                return Response({"خطأ": "بيانات المنتج غير صالحة"}, status=status.HTTP_400_BAD_REQUEST)
+            lines[product_id] = quantity
+
+        # Validate every line with one id__in query before writing anything
+        found = Product.objects.in_bulk(lines)
+        missing = [str(product_id) for product_id in lines if product_id not in found]
+        if missing:
+            return Response({"خطأ": f"المنتج غير موجود: {', '.join(missing)}"}, status=status.HTTP_404_NOT_FOUND)
+        for product_id, quantity in lines.items():
+            if found[product_id].quantity < quantity:
+                return Response({"خطأ": f"لا توجد كمية كافية من {found[product_id].title}"}, status=status.HTTP_400_BAD_REQUEST)
 
+        try:
+            cart_id = cart_store.set_items(cart_id or None, lines)
+        except CartLocked:
+            return Response({"خطأ": "السلة قيد التحديث، يرجى المحاولة مرة اخرى"}, status=status.HTTP_409_CONFLICT)
+        # The cart may have expired since the exists() check above
+        cart = cart_store.load(cart_id) if cart_id else None
+        if cart is None:
+            return Response({"خطأ": "السلة غير موجودة"}, status=status.HTTP_404_NOT_FOUND)
+        bump_cart_version(cart_id)
         serializer = CartSerializer(cart)
         return Response({
             "cart_id": str(cart.cart_id),
@@ -164,6 +233,9 @@ class AddToCartView(APIView):
 
 
 class ViewCartView(APIView):
+    # Everything the serialized cart reads besides the cart rows themselves
+    cache_models = (Product, ProductImage, brand, SubSection, Coupon)
+
     @swagger_auto_schema(
         manual_parameters=[
             openapi.Parameter(
@@ -179,12 +251,24 @@ class ViewCartView(APIView):
         cart_id = request.query_params.get('cart_id')
         if not cart_id:
             return Response({"خطأ": "رقم السلة مطلوبة"}, status=status.HTTP_400_BAD_REQUEST)
-        try:
-            cart = Cart.objects.get(cart_id=cart_id)
-        except Cart.DoesNotExist:
+
+        cart_store = get_cart_store()
+        # Checked first so unknown ids never get a version key
+        if not cart_store.exists(cart_id):
+            return Response({"خطأ": "السلة فارغة او غير موجودة"}, status=status.HTTP_404_NOT_FOUND)
+
+        versions = get_catalog_versions(self.cache_models) + (get_cart_version(cart_id),)
+        etag = make_etag(cart_id, request.accepted_media_type, *versions)
+        last_modified = last_modified_from(versions)
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        cart = cart_store.load(cart_id)
+        if cart is None:
             return Response({"خطأ": "السلة فارغة او غير موجودة"}, status=status.HTTP_404_NOT_FOUND)
         serializer = CartSerializer(cart)
-        return Response(serializer.data)
+        return set_validators(Response(serializer.data), etag, last_modified)
 
 @method_decorator(csrf_exempt, name='dispatch')
 class ApplyCouponView(APIView):
@@ -544,19 +628,18 @@ class CheckoutView(APIView):
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
 
+        cart_store = get_cart_store()
         try:
-            with transaction.atomic():
+            with transaction.atomic(), cart_store.checkout(data["cart_id"]) as cart:
                 
-                try:
-                    cart = Cart.objects.select_for_update().get(cart_id=data["cart_id"])
-                except Cart.DoesNotExist:
+                if cart is None:
                     return Response(
                         {"خطأ": "السلة غير موجودة"},
                         status=status.HTTP_404_NOT_FOUND
                     )
 
                
-                if cart.items.count() == 0:
+                if not cart.items.all():
                     return Response(
                         {"خطأ": "السلة فارغة"},
                         status=status.HTTP_400_BAD_REQUEST
@@ -576,17 +659,24 @@ class CheckoutView(APIView):
                             {"خطأ": "انتهت صلاحية الكوبون"},
                             status=status.HTTP_400_BAD_REQUEST
                         )
-                    cart.applied_coupon = coupon
-                    cart.save()
+                    cart_store.set_coupon(cart, coupon)
                 else:
-                    cart.applied_coupon = None
-                    cart.save()
+                    cart_store.set_coupon(cart, None)
+                transaction.on_commit(partial(bump_cart_version, cart.cart_id))
 
-                
-                try:
-                    send_whatsapp_otp(data["phone_number"])
-                except Exception as e:
-                    raise Exception("فشل في ارسال الرمز : " + str(e))
+                if not claim_otp_send(data["phone_number"]):
+                    return Response(
+                        {"خطأ": "تم ارسال رمز مؤخراً، يرجى الانتظار قبل طلب رمز جديد"},
+                        status=status.HTTP_429_TOO_MANY_REQUESTS,
+                        headers={"Retry-After": str(settings.OTP_RESEND_INTERVAL)}
+                    )
+
+                # The code is issued here; only the Twilio call goes to a
+                # worker, once the cart lock is released
+                otp = issue_otp(data["phone_number"])
+                otp_request_id = uuid.uuid4().hex
+                set_otp_status(otp_request_id, OTP_PENDING)
+                transaction.on_commit(partial(enqueue_otp, data["phone_number"], otp, otp_request_id))
 
                 
                 total_after_discount = cart.calculate_total()
@@ -599,40 +689,45 @@ class CheckoutView(APIView):
             )
 
         return Response({
-            "message": "تم ارسال الرمز بنجاح، يرجى تفقد الواتساب الخاص بك",
+            "message": "جاري ارسال الرمز، يرجى تفقد الواتساب الخاص بك",
+            "otp_request_id": otp_request_id,
+            "otp_status": OTP_PENDING,
             "checkout_data": {
                 "cart_id": data["cart_id"],
                 "username": data["username"],
                 "government": data["government"],
                 "address": data["address"],
                 "phone_number": data["phone_number"],
-                "coupon_code": data["coupon_code"],
+                "coupon_code": data.get("coupon_code"),
                 "total": total_after_discount,
             }
-        }, status=status.HTTP_200_OK)
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class OTPStatusView(APIView):
+    """
+    Polled after checkout until the OTP is sent or has failed.
+    """
 
+    def get(self, request, otp_request_id):
+        otp_status = get_otp_status(otp_request_id)
+        if otp_status is None:
+            return Response({"خطأ": "طلب الرمز غير موجود او منتهي الصلاحية"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({"otp_request_id": otp_request_id, "otp_status": otp_status})
 
-class BannerViewSet(viewsets.ReadOnlyModelViewSet):
+
+class BannerViewSet(CatalogCacheMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = BannerSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['section', 'subsection']
     ordering_fields = ['created_at', 'name']
     ordering = ['created_at']
+    # Section/SubSection deletes null out banner FKs without a Banner signal
+    cache_models = (Banner, Section, SubSection)
 
     def get_queryset(self):
         return Banner.objects.select_related('section', 'subsection').order_by('created_at')
 
-    def list(self, request, *args, **kwargs):
-        queryset = self.filter_queryset(self.get_queryset())
-        page = self.paginate_queryset(queryset)
-
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
-
 
 class VerifyOTPSerializer(serializers.Serializer):
     cart_id = serializers.CharField()
@@ -685,16 +780,15 @@ class VerifyOTPAndPurchaseView(APIView):
             return Response({"خطأ": "الرمز غير صحيح"}, status=status.HTTP_400_BAD_REQUEST)
 
         
+        cart_store = get_cart_store()
         try:
-            with transaction.atomic():
+            with transaction.atomic(), cart_store.checkout(data["cart_id"]) as cart:
                 
-                try:
-                    cart = Cart.objects.select_for_update().get(cart_id=data["cart_id"])
-                except Cart.DoesNotExist:
+                if cart is None:
                     return Response({"خطأ": "السلة غير موجودة"}, status=status.HTTP_404_NOT_FOUND)
 
                 
-                if cart.items.count() == 0:
+                if not cart.items.all():
                     return Response({"خطأ": "السلة فارغة"}, status=status.HTTP_400_BAD_REQUEST)
 
                
@@ -712,29 +806,30 @@ class VerifyOTPAndPurchaseView(APIView):
                     coupon=getattr(cart, 'applied_coupon', None)  
                 )
 
-                order_items = []
-                
-                for item in cart.items.select_related("product"):
-                    product = item.product
-                    if product.quantity < item.quantity:
-                        raise Exception(f"لا توجد كمية كافية من {product.title}.")
-                    
-                    product.update_stock(-item.quantity)
-                    order_items.append(OrderItem(
+                Product.objects.reserve_stock({item.product.pk: item.quantity for item in cart.items.all()})
+
+                OrderItem.objects.bulk_create([
+                    OrderItem(
                         order=order,
-                        product=product,
+                        product=item.product,
                         quantity=item.quantity,
-                        total_price=item.get_total_price()  
-                    ))
-
-                OrderItem.objects.bulk_create(order_items)
+                        total_price=item.get_total_price()
+                    )
+                    for item in cart.items.all()
+                ])
 
                 order.total = order.calculate_total_price()
                 order.save()
+                # Telegram & co. are told by the outbox drain, not on the request path
+                record_order_events(order)
+                transaction.on_commit(schedule_outbox_drain)
 
                 
-                cart.items.all().delete()
-                cart.delete()
+                cart_store.delete(cart)
+                transaction.on_commit(partial(delete_cart_versions, [cart.cart_id]))
+        except ValidationError as e:
+            # Every short product at once, so the customer can fix the cart in one go
+            return Response({"خطأ": e.messages}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
            
             return Response({"خطأ": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -742,12 +837,9 @@ class VerifyOTPAndPurchaseView(APIView):
         
         cache.delete(f"otp:{phone_number}")
 
-        
-        try:
-            send_order_to_telegram(customer, order)
-        except Exception as e:
-            print(f"⚠️ Telegram notification failed: {e}")
-
+        order = Order.objects.prefetch_related(
+            models.Prefetch('items__product', queryset=Product.objects.with_details())
+        ).get(pk=order.pk)
         order_data = OrderSerializer(order).data
         return Response({"الرسالة": "تم الطلب بنجاح", "الطلب": order_data}, status=status.HTTP_201_CREATED)
 
@@ -755,21 +847,18 @@ class VerifyOTPAndPurchaseView(APIView):
 def save_device_token(request):
     """
     Endpoint to save the device token and platform.
+    Accepts one {token, platform} object or a list of them.
     """
+    many = isinstance(request.data, list)
     # Create an instance of the serializer with the incoming data
-    serializer = DeviceTokenSerializer(data=request.data)
+    serializer = DeviceTokenSerializer(data=request.data, many=many)
 
     # Validate the data using the serializer
     if serializer.is_valid():
-        # If valid, save the device token or update existing token
-        token = serializer.validated_data['token']
-        platform = serializer.validated_data['platform']
-
-        # Update or create the device token in the database
-        device_token, created = DeviceToken.objects.update_or_create(
-            token=token,
-            defaults={'platform': platform}
-        )
+        registrations = serializer.validated_data if many else [serializer.validated_data]
+
+        # Upsert every token in one statement; recently seen tokens are skipped
+        register_device_tokens({item['token']: item['platform'] for item in registrations})
 
         # Return success response
         return Response({"message": "Device token saved successfully."}, status=status.HTTP_201_CREATED)
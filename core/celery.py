@@ -1,4 +1,5 @@
 from celery import Celery
+from celery.signals import worker_process_init
 import os
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
@@ -8,3 +9,11 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Autodiscover tasks from installed apps
 app.autodiscover_tasks()
+
+
+@worker_process_init.connect
+def warm_up_worker(**kwargs):
+    # Each pool process builds its own push clients before taking tasks
+    from api.apns import warm_up_push_clients
+
+    warm_up_push_clients()
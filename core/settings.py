@@ -3,6 +3,8 @@ from pathlib import Path
 import environ
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 env = environ.Env(
     DEBUG=(bool, False),
     CORS_ALLOW_CREDENTIALS=(bool, False),
@@ -13,6 +15,20 @@ env = environ.Env(
 CELERY_BROKER_URL = 'redis://localhost:6379/0'  # Redis as the broker
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
+CELERY_BEAT_SCHEDULE = {
+    'reap-abandoned-carts': {
+        'task': 'api.tasks.reap_abandoned_carts',
+        'schedule': 60 * 60,
+    },
+    'drain-order-outbox': {
+        'task': 'api.tasks.drain_order_outbox',
+        'schedule': 30,
+    },
+    'dispatch-pending-alerts': {
+        'task': 'api.tasks.dispatch_pending_alerts',
+        'schedule': 60,
+    },
+}
 
 
 FCM_CREDENTIALS_PATH = '/path/to/your/firebase/credentials.json'
@@ -42,6 +58,37 @@ DATABASES = {
 }
 
 
+# Catalog and cart versions, OTPs and throttles are written by one process and
+# read by the others, so outside DEBUG CACHE_URL must name a shared cache
+# (redis://...); an unset or process-local one fails startup.
+if DEBUG:
+    CACHES = {'default': env.cache('CACHE_URL', default='locmemcache://')}
+else:
+    CACHES = {'default': env.cache('CACHE_URL')}
+    if CACHES['default']['BACKEND'] in (
+        'django.core.cache.backends.locmem.LocMemCache',
+        'django.core.cache.backends.dummy.DummyCache',
+    ):
+        raise ImproperlyConfigured("CACHE_URL must name a cache shared by every process (e.g. redis://).")
+
+CATALOG_CACHE_TIMEOUT = env.int('CATALOG_CACHE_TIMEOUT', default=60 * 60)
+
+# api.cart_store.CacheCartStore keeps anonymous carts in the cache (Redis)
+# until they are ordered; api.cart_store.DatabaseCartStore uses Cart rows
+CART_STORE = env('CART_STORE', default='api.cart_store.DatabaseCartStore')
+CART_SESSION_TIMEOUT = env.int('CART_SESSION_TIMEOUT', default=60 * 60 * 24 * 7)
+ABANDONED_CART_DAYS = env.int('ABANDONED_CART_DAYS', default=30)
+
+# Where new orders are announced; each entry is a callable taking a list of orders
+ORDER_EVENT_SINKS = {
+    'telegram': 'api.outbox.telegram_sink',
+}
+# Seconds before the first retry of a failed delivery; doubles on every attempt
+ORDER_EVENT_RETRY_DELAY = env.int('ORDER_EVENT_RETRY_DELAY', default=30)
+# How long a drain may take to deliver a claimed batch before another drain can retry it
+ORDER_EVENT_CLAIM_TIMEOUT = env.int('ORDER_EVENT_CLAIM_TIMEOUT', default=600)
+
+
 
 APNS_TEAM_ID = os.getenv('APNS_TEAM_ID', 'YOUR_TEAM_ID')  # Not used directly in ApnsConfig
 APNS_AUTH_KEY_ID = os.getenv('APNS_KEY_ID', 'YOUR_KEY_ID')
@@ -49,10 +96,18 @@ APNS_AUTH_KEY_PATH = os.getenv('APNS_BUNDLE_ID', 'com.example.yourapp')
 APNS_BUNDLE_ID = os.getenv('APNS_AUTH_KEY', '/path/to/AuthKey_XXXXXXXXXX.p8')
 APNS_USE_SANDBOX = os.getenv('APNS_USE_SANDBOX', 'True') == 'True'  # True for sandbox, False for production
 APNS_AUTH_KEY_FILEPATH =  '/path/to/AuthKey_AUTH_KEY_ID.p8'
+# Requests in flight on the single HTTP/2 connection during a broadcast
+APNS_CONCURRENCY = env.int('APNS_CONCURRENCY', default=200)
+# A broadcast whose worker hasn't reported a batch for this long is resumed by another
+ALERT_STALL_TIMEOUT = env.int('ALERT_STALL_TIMEOUT', default=600)
+# Re-registrations of a token within this many seconds skip the database
+DEVICE_TOKEN_TOUCH_INTERVAL = env.int('DEVICE_TOKEN_TOUCH_INTERVAL', default=60 * 60 * 12)
 
 
 TELEGRAM_CHAT_ID = env('TELEGRAM_CHAT_ID')
 TELEGRAM_BOT_TOKEN= env('TELEGRAM_BOT_TOKEN')
+# Telegram allows about 20 messages a minute into one group chat
+TELEGRAM_MESSAGES_PER_MINUTE = env.int('TELEGRAM_MESSAGES_PER_MINUTE', default=20)
 
 
 
@@ -60,6 +115,9 @@ TELEGRAM_BOT_TOKEN= env('TELEGRAM_BOT_TOKEN')
 TWILIO_ACCOUNT_SID= env('TWILIO_ACCOUNT_SID')
 TWILIO_AUTH_TOKEN=env('TWILIO_AUTH_TOKEN')
 TWILIO_VERIFY_SERVICE_SID=env('TWILIO_VERIFY_SERVICE_SID')
+# How long a code stays valid, and how soon the same number may ask again
+OTP_TIMEOUT = env.int('OTP_TIMEOUT', default=600)
+OTP_RESEND_INTERVAL = env.int('OTP_RESEND_INTERVAL', default=60)
 
 
 ALLOWED_HOSTS = []
@@ -201,5 +259,22 @@ LOGGING = {
 }
 
 
-MEDIA_URL = '/media/'  
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
\ No newline at end of file
+MEDIA_URL = env('MEDIA_URL', default='/media/')
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Set to nginx's internal location for MEDIA_ROOT (e.g. /protected-media/)
+# to have nginx send media files instead of Django
+MEDIA_ACCEL_REDIRECT = env('MEDIA_ACCEL_REDIRECT', default='')
+# Browser cache lifetime for uploads saved before names were content hashes
+MEDIA_CACHE_SECONDS = env.int('MEDIA_CACHE_SECONDS', default=60 * 60)
+
+STORAGES = {
+    # Uploads are named by their content, so their URLs can be cached forever
+    'default': {'BACKEND': 'api.storage.HashedFileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+# Widths (px) of the resized copies made of every uploaded catalog image
+IMAGE_VARIANT_WIDTHS = [160, 320, 640, 1280]
+IMAGE_VARIANT_QUALITY = 80
+# Width (px) of the blurred preview inlined in API responses
+IMAGE_PLACEHOLDER_WIDTH = 16
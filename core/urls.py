@@ -1,12 +1,14 @@
 # project/urls.py
 
+import re
+
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from debug_toolbar.toolbar import debug_toolbar_urls
 from django.conf import settings
-from django.conf.urls.static import static
+from api.media import serve_media
 
 
 
@@ -31,5 +33,8 @@ urlpatterns = [
 
 ]+ debug_toolbar_urls()
 
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+# Skipped when MEDIA_URL points at a CDN or another host
+if settings.MEDIA_URL.startswith('/'):
+    urlpatterns += [
+        re_path(rf'^{re.escape(settings.MEDIA_URL.strip("/"))}/(?P<path>.*)$', serve_media, name='media'),
+    ]